@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Project folders import their modules by plain name, as their notebooks (run from
+# inside the folder) do, so tests next to those modules need the folders on the
+# path too.
+ROOT = os.path.dirname(os.path.abspath(__file__))
+for project in ('proj_rain_events', 'proj_trajectories'):
+    sys.path.insert(0, os.path.join(ROOT, project))
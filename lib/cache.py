@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+import xarray as xr
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CACHE_DIR = os.getenv('WEATHER_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'weather-projects'))
+MAX_CACHE_BYTES = int(float(os.getenv('WEATHER_CACHE_MAX_GB', 20)) * 1e9)
+
+# when set, never go to the network: cache misses raise FileNotFoundError
+OFFLINE = os.getenv('WEATHER_OFFLINE', '') not in ('', '0')
+
+# HDF5 isn't thread safe, so local NetCDF files are opened and written under this
+# lock when loaders run on threads
+NETCDF_LOCK = threading.Lock()
+
+_SHARED = {}
+_SHARED_LOCK = threading.Lock()
+
+
+# Content-addressed local NetCDF cache for datasets pulled from remote services.
+#
+# Entries are keyed by the SHA-256 of a JSON description of the request (source,
+# product, year, subset query, ...), so the same request always maps to the same
+# file. An index alongside the files records each entry's size, checksum and last
+# access; once the cache grows past max_bytes, the least recently used entries are
+# evicted. Checksums are verified on read and corrupt entries are re-fetched.
+#
+# Every change to the index re-reads it from disk under a lock file and writes it
+# straight back, so caches in other processes (or other instances on the same
+# directory) sharing the directory keep each other's entries. Within a process,
+# modules share one instance per directory through DatasetCache.shared.
+class DatasetCache(object):
+    INDEX_FILE = 'index.json'
+    LOCK_FILE = 'index.lock'
+
+    def __init__(self, directory=None, max_bytes=None, offline=None, validate=True):
+        self.directory = directory or CACHE_DIR
+        self.max_bytes = MAX_CACHE_BYTES if max_bytes is None else max_bytes
+        self.offline = OFFLINE if offline is None else offline
+        self.validate = validate
+        self._lock = threading.RLock()
+        self._index = None
+
+    # The instance for `directory` (CACHE_DIR by default) used by every module of
+    # this process.
+    @classmethod
+    def shared(cls, directory=None):
+        directory = os.path.abspath(directory or CACHE_DIR)
+        with _SHARED_LOCK:
+            if directory not in _SHARED:
+                _SHARED[directory] = cls(directory)
+            return _SHARED[directory]
+
+    @staticmethod
+    def key(**parts):
+        desc = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(desc.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.nc')
+
+    # Returns the cached dataset for `parts`, calling fetch() and storing its
+    # result on a miss.
+    #
+    # Data whose source may still change until `complete_after` (a Timestamp, e.g.
+    # just after the end of a year still being appended to) is fetched again once
+    # its entry is older than `max_age` (a Timedelta), for as long as the entry was
+    # written before that time. Offline, such entries are used however old.
+    def get(self, fetch, complete_after=None, max_age=None, **parts):
+        path = self.get_path(fetch, complete_after, max_age, **parts)
+        with NETCDF_LOCK:
+            return xr.open_dataset(path)
+
+    # Same as get, but returns the path of the cached NetCDF file, e.g. to open it
+    # with dask chunks.
+    def get_path(self, fetch, complete_after=None, max_age=None, **parts):
+        key = self.key(**parts)
+        if self._check(key, None if self.offline else complete_after, max_age):
+            return self.path(key)
+
+        if self.offline:
+            raise FileNotFoundError(f'{parts} is not in the cache at {self.directory} and offline mode is on')
+
+        ds = fetch()
+        self._write(key, ds, parts)
+        return self.path(key)
+
+    # The index as of the last read or change
+    @property
+    def index(self):
+        with self._lock:
+            if self._index is None:
+                self._index = self._read_index()
+            return self._index
+
+    def size(self):
+        with self._lock:
+            return sum(entry['bytes'] for entry in self.index.values())
+
+    def clear(self):
+        with self._updating():
+            for key in list(self.index):
+                self._remove(key)
+
+    # whether `key` has a valid entry that isn't due a refresh (see get); marks it
+    # as most recently used if so
+    def _check(self, key, complete_after=None, max_age=None):
+        with self._lock:
+            entry = self.index.get(key)
+            if entry is None:
+                # possibly added by another process since the index was read
+                self._index = self._read_index()
+                entry = self._index.get(key)
+        path = self.path(key)
+        if entry is None or not os.path.exists(path):
+            return False
+
+        written = entry.get('written', 0.)
+        if (complete_after is not None and written < pd.Timestamp(complete_after).timestamp()
+                and time.time() - written > pd.Timedelta(max_age or 0).total_seconds()):
+            return False
+
+        if self.validate and _sha256(path) != entry['sha256']:
+            print(f'Cache entry {key} failed checksum validation, removing')
+            with self._updating():
+                self._remove(key)
+            return False
+
+        with self._updating():
+            if key in self.index:
+                self.index[key]['accessed'] = time.time()
+        return True
+
+    def _write(self, key, ds, parts):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with NETCDF_LOCK:
+            ds.to_netcdf(tmp_path)
+
+        with self._updating():
+            os.replace(tmp_path, path)
+            self.index[key] = {
+                'parts': json.loads(json.dumps(parts, default=str)),
+                'bytes': os.path.getsize(path),
+                'sha256': _sha256(path),
+                'written': time.time(),
+                'accessed': time.time(),
+            }
+            self._evict(keep=key)
+
+    def _evict(self, keep=None):
+        total = self.size()
+        for key, entry in sorted(self.index.items(), key=lambda item: item[1]['accessed']):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= entry['bytes']
+            self._remove(key)
+
+    def _remove(self, key):
+        self.index.pop(key, None)
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    # Holds the lock file while the block changes self.index, starting from the
+    # index on disk, and saves it afterwards.
+    @contextmanager
+    def _updating(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock, open(os.path.join(self.directory, self.LOCK_FILE), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._index = self._read_index()
+                yield
+                self._save_index()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        index_path = os.path.join(self.directory, self.INDEX_FILE)
+        if not os.path.exists(index_path):
+            return {}
+        with open(index_path) as f:
+            return json.load(f)
+
+    # only called from _updating, with the lock file held
+    def _save_index(self):
+        index_path = os.path.join(self.directory, self.INDEX_FILE)
+        tmp_path = f'{index_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, index_path)
+
+
+def _sha256(path, blocksize=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
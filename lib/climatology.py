@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+# Long-term-mean (LTM) datasets (e.g. NCEP's hgt.mon.ltm.nc or *.day.1981-2010.ltm.nc)
+# hold one climatological year stamped with a placeholder year. Rather than copying
+# that year once per year of data, these helpers map every data time to the
+# position of its matching LTM time (same month, day and hour) and index the LTM
+# with that map, so memory scales with the data, not with years x climatology.
+
+
+# Position in `ltm_times` of the LTM time matching each of `times`. Feb 29 falls
+# back to Feb 28 when the climatology has no leap day; times with no match at all
+# raise a KeyError.
+def ltm_positions(times, ltm_times):
+    times = _time_parts(times)
+    ltm_times = _time_parts(ltm_times)
+    lookup = pd.Series(np.arange(len(ltm_times)), index=ltm_times)
+    if lookup.index.has_duplicates:
+        raise ValueError('LTM times must be unique by month, day and hour')
+
+    positions = lookup.reindex(times)
+    missing = positions.isna().values
+    if missing.any():
+        leap_days = missing & (times.get_level_values('month') == 2) & (times.get_level_values('day') == 29)
+        feb28 = pd.MultiIndex.from_arrays([
+            times.get_level_values('month'), np.where(leap_days, 28, times.get_level_values('day')),
+            times.get_level_values('hour'),
+        ], names=times.names)
+        positions = positions.fillna(lookup.reindex(feb28).set_axis(positions.index))
+
+    if positions.isna().any():
+        unmatched = times[positions.isna().values][:5].tolist()
+        raise KeyError(f'No LTM time matches (month, day, hour) {unmatched}')
+    return positions.values.astype(np.intp)
+
+
+# The LTM at each of `times` (e.g. data.time), stamped with those times.
+def ltm_at(ltm, times, dim='time'):
+    times = np.asarray(times)
+    aligned = ltm.isel({dim: ltm_positions(times, ltm[dim].values)})
+    return aligned.assign_coords({dim: times})
+
+
+# Departure of `data` from the climatology `ltm`, aligned on month, day and hour.
+def anomalies(data, ltm, dim='time'):
+    return data - ltm_at(ltm, data[dim].values, dim=dim)
+
+
+# LTM repeated for each of `years` with real timestamps, built from one index map
+# rather than a copy per year. Dates that don't exist in a year (Feb 29 in a leap
+# year climatology) are dropped.
+def ltm_for_years(ltm, years, dim='time'):
+    parts = _time_parts(ltm[dim].values)
+    n = len(parts)
+    times = pd.to_datetime(pd.DataFrame({
+        'year': np.repeat(list(years), n),
+        'month': np.tile(parts.get_level_values('month'), len(years)),
+        'day': np.tile(parts.get_level_values('day'), len(years)),
+        'hour': np.tile(parts.get_level_values('hour'), len(years)),
+    }), errors='coerce')
+
+    positions = np.tile(np.arange(n), len(years))
+    valid = ~times.isna().values
+    result = ltm.isel({dim: positions[valid]})
+    return result.assign_coords({dim: times.values[valid]})
+
+
+# Composite mean, variance and count of `read(times)` (the data, a DataArray along
+# `dim`, at those times) for each group of times in `groups`, a dict of name ->
+# list of times (e.g. event dates by event type) or a single list. The union of
+# all groups' times is read once, `batch` times at a time, and each batch is folded
+# into the running statistics of every group it has times of (Chan et al.'s
+# pairwise update), so memory is one batch plus the running statistics, and groups
+# sharing times share their reads. A time listed twice in a group counts twice.
+#
+# Returns a Dataset of mean, variance (ddof=1) and count along a `group` dim, or
+# without it for a single list.
+def composite(read, groups, batch=120, dim='time'):
+    single = not isinstance(groups, dict)
+    groups = {'composite': groups} if single else groups
+    groups = {name: pd.DatetimeIndex(times) for name, times in groups.items()}
+    union = pd.DatetimeIndex(np.unique(np.concatenate([times.values for times in groups.values()])))
+    weights = np.stack([np.bincount(union.get_indexer(times), minlength=len(union))
+                        for times in groups.values()]).astype(np.float64)
+
+    count = mean = m2 = template = None
+    for lo in range(0, len(union), batch):
+        data = read(union[lo:lo + batch])
+        data = data.transpose(dim, ...).load()
+        x = data.values.astype(np.float64)
+        if template is None:
+            template = data.isel({dim: 0}, drop=True)
+            count = np.zeros(len(groups))
+            mean = np.zeros((len(groups),) + x.shape[1:])
+            m2 = np.zeros_like(mean)
+
+        w = weights[:, lo:lo + batch]
+        n_b = w.sum(axis=1)
+        for g in np.flatnonzero(n_b):
+            mean_b = np.tensordot(w[g], x, axes=1) / n_b[g]
+            m2_b = np.tensordot(w[g], (x - mean_b) ** 2, axes=1)
+            n = count[g] + n_b[g]
+            delta = mean_b - mean[g]
+            mean[g] += delta * n_b[g] / n
+            m2[g] += m2_b + delta ** 2 * count[g] * n_b[g] / n
+            count[g] = n
+
+    dims = ('group',) + template.dims
+    coords = {**template.coords, 'group': list(groups)}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        variance = m2 / (count - 1).reshape((-1,) + (1,) * template.ndim)
+    result = xr.Dataset({
+        'mean': (dims, mean.astype(template.dtype)),
+        'variance': (dims, variance.astype(template.dtype)),
+        'count': ('group', count.astype(np.int64)),
+    }, coords=coords)
+    return result.isel(group=0, drop=True) if single else result
+
+
+def _time_parts(times):
+    times = xr.DataArray(np.asarray(times), dims='time')
+    return pd.MultiIndex.from_arrays([
+        times.dt.month.values, times.dt.day.values, times.dt.hour.values,
+    ], names=['month', 'day', 'hour'])
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy import special
+
+
+# Pearson correlation of a station or index time series with every point of a
+# gridded field (e.g. the anomalies from lib.reanalysis.r1.hgt_monthly), with the
+# regression slope of the field on the series and the two-sided p-value of r.
+#
+# `series` is a pd.Series or DataArray along `dim`, matched to the field's times
+# by label; times missing from it (or NaN) are left out. With `lags` (steps along
+# the field's time axis, an int or a list), the field at t - lag is paired with
+# the series at t, so positive lags have the field leading. `months` keeps only
+# pairs whose series time falls in those months (e.g. (12, 1, 2) for winter).
+#
+# All lags come out of three matrix products of the (lag, time) matrix of centred
+# series values and its mask with the field, so the work is a couple of passes
+# over the field and stays lazy for dask-backed fields. Returns a Dataset of r,
+# slope, p_value and n, with a `lag` dim if `lags` is a list.
+def correlation_map(series, field, lags=0, months=None, dim='time'):
+    single = np.ndim(lags) == 0
+    lags = np.atleast_1d(lags)
+    times = pd.DatetimeIndex(field[dim].values)
+
+    if isinstance(series, xr.DataArray):
+        series = series.to_series()
+    values = series.reindex(times).to_numpy(dtype=np.float64)
+    if months is not None:
+        values = np.where(times.month.isin(np.atleast_1d(months)), values, np.nan)
+
+    x = np.stack([_shift(values, -lag) for lag in lags])
+    mask = ~np.isnan(x)
+    n = mask.sum(axis=1)
+    x = np.where(mask, x - np.nanmean(np.where(mask, x, np.nan), axis=1, keepdims=True), 0.)
+
+    x = xr.DataArray(x, dims=('lag', dim), coords={'lag': lags, dim: field[dim].values})
+    mask = xr.DataArray(mask.astype(np.float64), dims=('lag', dim), coords=x.coords)
+    y = (field - field.mean(dim)).astype(np.float64)
+
+    sxy = xr.dot(x, y, dim=dim)
+    sy = xr.dot(mask, y, dim=dim)
+    syy = xr.dot(mask, y ** 2, dim=dim)
+    n = xr.DataArray(n, dims='lag', coords={'lag': lags})
+    sxx = (x ** 2).sum(dim)
+    syy = syy - sy ** 2 / n
+
+    r = sxy / np.sqrt(sxx * syy)
+    result = xr.Dataset({
+        'r': r,
+        'slope': sxy / sxx,
+        'p_value': xr.apply_ufunc(_p_value, r, n, dask='parallelized', output_dtypes=[np.float64]),
+        'n': n,
+    })
+    return result.isel(lag=0, drop=True) if single else result
+
+
+# `values` moved `steps` positions later (earlier for negative steps), NaN-filled
+def _shift(values, steps):
+    shifted = np.full_like(values, np.nan)
+    if steps >= 0:
+        shifted[steps:] = values[:len(values) - steps]
+    else:
+        shifted[:steps] = values[-steps:]
+    return shifted
+
+
+# two-sided p-value of Pearson's r from n pairs, from the t distribution with n - 2
+# degrees of freedom
+def _p_value(r, n):
+    df = n - 2.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t2 = r ** 2 * df / (1 - r ** 2)
+        return special.betainc(df / 2, 0.5, df / (df + t2))
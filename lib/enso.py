@@ -1,4 +1,12 @@
+import io
+import os
+import time
+
+import numpy as np
 import pandas as pd
+import requests
+
+from lib import cache
 
 TRIMONTHLY_MAPPING = {
     'DJF': 1,
@@ -15,12 +23,122 @@ TRIMONTHLY_MAPPING = {
     'NDJ': 12,
 }
 
+# Monthly climate indices, as published by CPC (and NCEI for the PDO). ONI values
+# are keyed by the middle month of their season.
+INDEX_SOURCES = {
+    'oni': 'https://www.cpc.ncep.noaa.gov/data/indices/oni.ascii.txt',
+    'ao': 'https://www.cpc.ncep.noaa.gov/products/precip/CWlink/daily_ao_index/monthly.ao.index.b50.current.ascii',
+    'nao': 'https://www.cpc.ncep.noaa.gov/products/precip/CWlink/pna/norm.nao.monthly.b5001.current.ascii',
+    'pna': 'https://www.cpc.ncep.noaa.gov/products/precip/CWlink/pna/norm.pna.monthly.b5001.current.ascii',
+    'pdo': 'https://www.ncei.noaa.gov/pub/data/cmb/ersst/v5/index/ersst.v5.pdo.dat',
+}
+
+# The index files are kept in INDEX_DIR and downloaded again once they are older
+# than REFRESH_AFTER. If that fails (or lib.cache.OFFLINE is set), the copy on disk
+# is used however old it is.
+INDEX_DIR = os.path.join(cache.CACHE_DIR, 'indices')
+REFRESH_AFTER = pd.Timedelta(1, 'D')
+
 
 def oni_trimonthly():
-    df = pd.read_csv('https://www.cpc.ncep.noaa.gov/data/indices/oni.ascii.txt', sep='\s+')
-    df['MONTH'] = df['SEAS'].apply(seas_to_mo)
+    df = pd.read_csv(io.StringIO(index_text('oni')), sep=r'\s+')
+    df['MONTH'] = df['SEAS'].map(TRIMONTHLY_MAPPING)
     return df
 
 
 def seas_to_mo(seas):
     return TRIMONTHLY_MAPPING[seas]
+
+
+# The monthly values of index `name` (a key of INDEX_SOURCES) as a Series keyed by
+# the first of each month.
+def climate_index(name):
+    if name not in INDEX_SOURCES:
+        raise ValueError(f'Unknown climate index {name!r}, expected one of {list(INDEX_SOURCES)}')
+    text = index_text(name)
+    if name == 'oni':
+        series = _parse_oni(text)
+    elif name == 'pdo':
+        series = _parse_year_rows(text)
+    else:
+        series = _parse_month_rows(text)
+    return series.rename(name).rename_axis('month')
+
+
+# Several indices as the columns of one frame keyed by month.
+def climate_indices(names=('oni', 'pdo', 'ao', 'pna')):
+    return pd.concat([climate_index(name) for name in names], axis=1)
+
+
+# `df` with the value of each of the indices `names` for the month of its `on`
+# column (a column of timestamps) added as columns of the same names, or that of
+# `lag_months` months earlier. Rows past the end of an index get NaN. One merge
+# for the whole table, whatever its size.
+def join_indices(df, on='valid', names=('oni',), lag_months=0):
+    indices = climate_indices(names)
+    indices.index = indices.index + pd.DateOffset(months=lag_months)
+    months = pd.to_datetime(df[on]).dt.to_period('M').dt.to_timestamp()
+    joined = indices.reindex(months.to_numpy())
+    joined.index = df.index
+    return df.assign(**{name: joined[name] for name in names})
+
+
+# ENSO phase of ONI values: 'nina' at or below -threshold, 'nino' at or above it,
+# 'neutral' between (and for missing values).
+def enso_phase(oni, threshold=0.5):
+    oni = np.asarray(oni, dtype=np.float64)
+    phase = np.select([oni <= -threshold, oni >= threshold], ['nina', 'nino'], 'neutral')
+    return pd.Categorical(phase, categories=['nina', 'neutral', 'nino'])
+
+
+# Text of index file `name`, from INDEX_DIR while it is fresh
+def index_text(name):
+    path = os.path.join(INDEX_DIR, f'{name}.txt')
+    fresh = os.path.exists(path) and time.time() - os.path.getmtime(path) < REFRESH_AFTER.total_seconds()
+    if fresh or (cache.OFFLINE and os.path.exists(path)):
+        with open(path) as f:
+            return f.read()
+    if cache.OFFLINE:
+        raise FileNotFoundError(f'{path} does not exist and offline mode is on')
+
+    try:
+        response = requests.get(INDEX_SOURCES[name], timeout=60)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        if not os.path.exists(path):
+            raise
+        print(f'Using the copy of {name} in {INDEX_DIR} after error: {e}')
+        with open(path) as f:
+            return f.read()
+
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(response.text)
+    os.replace(tmp_path, path)
+    return response.text
+
+
+# SEAS YR TOTAL ANOM rows
+def _parse_oni(text):
+    df = pd.read_csv(io.StringIO(text), sep=r'\s+')
+    months = pd.to_datetime(pd.DataFrame({'year': df.YR, 'month': df.SEAS.map(TRIMONTHLY_MAPPING), 'day': 1}))
+    return pd.Series(df.ANOM.to_numpy(), index=pd.DatetimeIndex(months))
+
+
+# year month value rows (AO, NAO, PNA); -99.9 and below is missing
+def _parse_month_rows(text):
+    df = pd.read_csv(io.StringIO(text), sep=r'\s+', header=None, names=['year', 'month', 'value'])
+    months = pd.to_datetime(df[['year', 'month']].assign(day=1))
+    values = df.value.to_numpy(dtype=np.float64)
+    return pd.Series(np.where(values <= -99.9, np.nan, values), index=pd.DatetimeIndex(months)).dropna()
+
+
+# one row of 12 monthly values per year, after a title line (PDO); 99.99 is missing
+def _parse_year_rows(text):
+    df = pd.read_csv(io.StringIO(text), sep=r'\s+', skiprows=1)
+    values = df.iloc[:, 1:13].to_numpy(dtype=np.float64)
+    months = pd.to_datetime(pd.DataFrame({'year': np.repeat(df.iloc[:, 0].to_numpy(), 12),
+                                          'month': np.tile(np.arange(1, 13), len(df)), 'day': 1}))
+    values = values.ravel()
+    return pd.Series(np.where(np.abs(values) >= 99.99, np.nan, values), index=pd.DatetimeIndex(months)).dropna()
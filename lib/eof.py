@@ -0,0 +1,170 @@
+import numpy as np
+import xarray as xr
+
+# Time steps are read MAX_CHUNK_BYTES (as float64) at a time, so fields far larger
+# than memory (e.g. daily ERA5 0.25 degree heights, opened lazily) can be used.
+# The leading modes come from a randomized SVD with OVERSAMPLE extra vectors and
+# POWER_ITERATIONS power iterations, each one more pass over the data.
+MAX_CHUNK_BYTES = 2 ** 28
+OVERSAMPLE = 10
+POWER_ITERATIONS = 2
+
+
+# EOF analysis of an anomaly field (e.g. the anomalies from
+# lib.reanalysis.r1.hgt_monthly, or a lazily opened ERA5 field less its
+# climatology), giving the leading `neofs` modes only. Called like eofs.xarray.Eof,
+# and eofs(), pcs() and varianceFraction() return DataArrays of the same names,
+# dims and scalings.
+#
+# `anomalies` is a DataArray along `dim`, numpy or dask-backed, read a chunk of
+# times at a time (`chunk` times, by default as many as fit in MAX_CHUNK_BYTES).
+# `weights` is 'coslat' for sqrt(cos(lat)) weighting by the lat or latitude
+# coordinate, None, or an array broadcastable to one time of the field. Points that
+# are missing must be missing at all times, and are left out. As in eofs, the time
+# mean is removed unless `center` is False.
+#
+# Reads are one pass for the mean and total variance, then POWER_ITERATIONS + 1
+# passes of A.T @ (A @ V) products for the randomized SVD of the weighted
+# anomalies A, so memory scales with the grid times neofs + OVERSAMPLE, not the
+# length of the record.
+class Eof(object):
+    def __init__(self, anomalies, neofs=10, weights='coslat', center=True, dim='time', chunk=None,
+                 oversample=None, power_iterations=None, seed=0):
+        anomalies = anomalies.transpose(dim, ...)
+        self.dim = dim
+        self.center = center
+        self._template = anomalies.isel({dim: 0}, drop=True).reset_coords(drop=True)
+        self._times = anomalies[dim]
+        self._weights = _weights(self._template, weights)
+
+        ntime = anomalies.sizes[dim]
+        npoints = self._template.size
+        self.chunk = chunk or max(1, int(MAX_CHUNK_BYTES // (8 * npoints)))
+        oversample = OVERSAMPLE if oversample is None else oversample
+        power_iterations = POWER_ITERATIONS if power_iterations is None else power_iterations
+
+        self._valid, self._mean, self.total_variance = self._moments(anomalies)
+        rank = min(ntime - int(center), int(self._valid.sum()))
+        if neofs < 1 or neofs > rank:
+            raise ValueError(f'neofs must be between 1 and {rank} for this field, got {neofs}')
+        self.neofs = neofs
+
+        size = min(neofs + oversample, rank)
+        rng = np.random.default_rng(seed)
+        basis = np.linalg.qr(rng.standard_normal((int(self._valid.sum()), size)))[0]
+        for _ in range(power_iterations):
+            basis = np.linalg.qr(self._power(anomalies, basis)[1])[0]
+        projected = self._power(anomalies, basis, transpose=False)[0]
+
+        u, s, vt = np.linalg.svd(projected, full_matrices=False)
+        self._u = u[:, :neofs]
+        self._s = s[:neofs]
+        self._flat_eofs = (basis @ vt[:neofs].T).T
+        self._eigenvalues = self._s ** 2 / (ntime - 1)
+
+    # EOFs along `mode`, scaled as in eofs: 0 unscaled, 1 divided by and 2
+    # multiplied by the square root of their eigenvalues. Missing points are NaN.
+    def eofs(self, eofscaling=0, neofs=None):
+        neofs = self._count(neofs)
+        flat = self._flat_eofs[:neofs] * self._scaling(eofscaling, neofs)[:, np.newaxis]
+        values = np.full((neofs, self._template.size), np.nan)
+        values[:, self._valid] = flat
+        return xr.DataArray(values.reshape((neofs,) + self._template.shape),
+                            dims=('mode',) + self._template.dims,
+                            coords={**self._template.coords, 'mode': np.arange(neofs)}, name='eofs')
+
+    # PCs along (dim, mode), scaled as in eofs: 0 unscaled, 1 to unit variance and
+    # 2 multiplied by the square root of their eigenvalues.
+    def pcs(self, pcscaling=0, npcs=None):
+        npcs = self._count(npcs)
+        if pcscaling not in (0, 1, 2):
+            raise ValueError(f'Invalid PC scaling option: {pcscaling!r}')
+        values = self._u[:, :npcs] * self._s[:npcs]
+        if pcscaling:
+            values = values * self._scaling(pcscaling, npcs)
+        return xr.DataArray(values, dims=(self.dim, 'mode'),
+                            coords={self.dim: self._times.values, 'mode': np.arange(npcs)}, name='pcs')
+
+    # Variances of the PCs, i.e. of the weighted field explained by each mode.
+    def eigenvalues(self, neigs=None):
+        neigs = self._count(neigs)
+        return xr.DataArray(self._eigenvalues[:neigs], dims='mode', coords={'mode': np.arange(neigs)},
+                            name='eigenvalues')
+
+    # Fraction of the total (weighted) variance of the field explained by each mode.
+    def varianceFraction(self, neigs=None):
+        fractions = self.eigenvalues(neigs) / self.total_variance
+        return fractions.rename('variance_fractions')
+
+    def _count(self, n):
+        return self.neofs if n is None else min(n, self.neofs)
+
+    def _scaling(self, scaling, n):
+        if scaling == 0:
+            return np.ones(n)
+        if scaling == 1:
+            return 1 / np.sqrt(self._eigenvalues[:n])
+        if scaling == 2:
+            return np.sqrt(self._eigenvalues[:n])
+        raise ValueError(f'Invalid EOF scaling option: {scaling!r}')
+
+    # Weighted values of the valid points, one chunk of times at a time
+    def _chunks(self, anomalies, centered=True):
+        for lo in range(0, anomalies.sizes[self.dim], self.chunk):
+            values = anomalies.isel({self.dim: slice(lo, lo + self.chunk)}).values
+            values = values.reshape(len(values), -1).astype(np.float64)
+            if self._weights is not None:
+                values *= self._weights
+            if centered:
+                values = values[:, self._valid]
+                if self.center:
+                    values -= self._mean
+            yield lo, values
+
+    # Points with data, their time mean and the total variance about it (ddof=1)
+    def _moments(self, anomalies):
+        valid = total = squares = None
+        ntime = anomalies.sizes[self.dim]
+        for _, values in self._chunks(anomalies, centered=False):
+            if valid is None:
+                valid = ~np.isnan(values[0])
+                total = np.zeros(int(valid.sum()))
+                squares = np.zeros_like(total)
+            values = values[:, valid]
+            if np.isnan(values).any():
+                raise ValueError('Missing values must be at the same points at all times')
+            total += values.sum(axis=0)
+            squares += (values ** 2).sum(axis=0)
+
+        mean = total / ntime if self.center else 0.
+        variance = squares - ntime * mean ** 2 if self.center else squares
+        return valid, mean, variance.sum() / (ntime - 1)
+
+    # A @ basis and, unless `transpose` is False, A.T @ (A @ basis), in one pass
+    def _power(self, anomalies, basis, transpose=True):
+        projected = np.empty((anomalies.sizes[self.dim], basis.shape[1]))
+        product = np.zeros_like(basis) if transpose else None
+        for lo, values in self._chunks(anomalies):
+            part = values @ basis
+            projected[lo:lo + len(part)] = part
+            if transpose:
+                product += values.T @ part
+        return projected, product
+
+
+# sqrt(cos(lat)) weights for 'coslat' (0 past the poles), else `weights` as given,
+# flattened over one time of the field
+def _weights(template, weights):
+    if weights is None:
+        return None
+    if isinstance(weights, str):
+        if weights != 'coslat':
+            raise ValueError(f"weights must be 'coslat', None or an array, got {weights!r}")
+        name = next((name for name in ('lat', 'latitude') if name in template.coords), None)
+        if name is None:
+            raise ValueError("'coslat' weights need a lat or latitude coordinate")
+        coslat = np.cos(np.deg2rad(template[name])).clip(0., 1.)
+        weights = np.sqrt(coslat)
+    if isinstance(weights, xr.DataArray):
+        weights = weights.broadcast_like(template).transpose(*template.dims).values
+    return np.broadcast_to(np.asarray(weights, dtype=np.float64), template.shape).ravel()
@@ -0,0 +1,104 @@
+import os
+import sys
+import tempfile
+import time
+
+import dask.array as da
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from lib.eof import Eof
+
+# (times, lats, lons), southernmost latitude and time step of the benchmark fields:
+# NCEP R1 monthly heights 1948-2020 on its 2.5 degree globe, and half a year of
+# daily ERA5 0.25 degree heights north of 20N (eofs runs out of 6 GB of memory at
+# a year).
+R1 = {'shape': (876, 73, 144), 'south': -90, 'freq': 'MS'}
+ERA5 = {'shape': (180, 281, 1440), 'south': 20, 'freq': 'D'}
+
+
+# Synthetic (time, lat, lon) anomalies from 90N to `south`, dask-backed and built a block of times at a
+# time: `nmodes` smooth patterns with red-noise PCs of decreasing variance, plus
+# white noise, so the leading EOFs are known and benchmarks don't need the
+# reanalysis files.
+def synthetic_anomalies(shape, south=-90, freq='MS', nmodes=6, noise=0.5, chunk=100, seed=0):
+    ntime, nlat, nlon = shape
+    lat = np.linspace(90, south, nlat)
+    lon = np.linspace(0, 360, nlon, endpoint=False)
+    y, x = np.meshgrid(np.deg2rad(lat), np.deg2rad(lon), indexing='ij')
+    patterns = np.stack([np.cos((k % 3 + 1) * y) * np.cos((k + 1) * x + k) for k in range(nmodes)])
+
+    rng = np.random.default_rng(seed)
+    pcs = np.zeros((ntime, nmodes))
+    shocks = rng.standard_normal((ntime, nmodes)) * 10. / (1 + np.arange(nmodes))
+    for t in range(ntime):
+        pcs[t] = 0.6 * pcs[t - 1] + shocks[t] if t else shocks[t]
+
+    def block(block_info=None):
+        lo, hi = block_info[None]['array-location'][0]
+        noise_rng = np.random.default_rng([seed, lo])
+        values = np.tensordot(pcs[lo:hi], patterns, axes=1)
+        return (values + noise * noise_rng.standard_normal(values.shape)).astype(np.float32)
+
+    data = da.map_blocks(block, chunks=((chunk,) * (ntime // chunk) + ((ntime % chunk,) if ntime % chunk else ()),
+                                        (nlat,), (nlon,)), dtype=np.float32)
+    return xr.DataArray(data, dims=('time', 'lat', 'lon'), name='hgt', coords={
+        'time': pd.date_range('1948-01-01', periods=ntime, freq=freq), 'lat': lat, 'lon': lon,
+    })
+
+
+# lib.eof.Eof against eofs.xarray.Eof on the same in-memory anomalies: time taken,
+# and how close the leading EOFs, PCs and variance fractions come (EOF signs are
+# arbitrary, so PCs are compared by |correlation|). eofs is imported here, as
+# nothing else needs it.
+def bench_eof(shape, south=-90, freq='MS', neofs=4):
+    from eofs.xarray import Eof as EofsEof
+
+    anomalies = synthetic_anomalies(shape, south, freq).load()
+    print(f'{shape} field, {anomalies.nbytes / 1e6:.0f} MB')
+
+    start = time.perf_counter()
+    solver = Eof(anomalies, neofs=neofs)
+    secs = time.perf_counter() - start
+    print(f'lib.eof.Eof: {secs:.2f} s')
+
+    coslat = np.cos(np.deg2rad(anomalies.coords['lat'].values)).clip(0., 1.)
+    start = time.perf_counter()
+    reference = EofsEof(anomalies, weights=np.sqrt(coslat)[..., np.newaxis])
+    reference_eofs = reference.eofs(neofs=neofs)
+    reference_secs = time.perf_counter() - start
+    print(f'eofs.xarray.Eof: {reference_secs:.2f} s ({reference_secs / secs:.1f}x lib.eof.Eof)')
+
+    pcs, reference_pcs = solver.pcs(pcscaling=1).values, reference.pcs(pcscaling=1, npcs=neofs).values
+    r = np.array([np.corrcoef(pcs[:, k], reference_pcs[:, k])[0, 1] for k in range(neofs)])
+    signs = np.sign(r)[:, np.newaxis, np.newaxis]
+    eof_diff = np.abs(solver.eofs().values - signs * reference_eofs.values).max()
+    fraction_diff = np.abs(solver.varianceFraction().values - reference.varianceFraction(neigs=neofs).values).max()
+    print(f'PC |r| {np.round(np.abs(r), 6)}, max EOF difference {eof_diff:.2e}, '
+          f'max variance fraction difference {fraction_diff:.2e}')
+
+
+# lib.eof.Eof reading a field of `ntime` times on the grid of `shape` from a zarr
+# store on disk, a chunk at a time; eofs would need all of it (and an SVD's worth
+# more) in memory.
+def bench_eof_streaming(shape, south=-90, freq='MS', ntime=1461, neofs=4):
+    shape = (ntime,) + tuple(shape[1:])
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'anomalies.zarr')
+        start = time.perf_counter()
+        synthetic_anomalies(shape, south, freq).to_dataset().to_zarr(path)
+        print(f'{shape} field, wrote {time.perf_counter() - start:.1f} s')
+
+        anomalies = xr.open_zarr(path).hgt
+        start = time.perf_counter()
+        solver = Eof(anomalies, neofs=neofs)
+        print(f'lib.eof.Eof from disk: {anomalies.nbytes / 1e9:.1f} GB, {solver.chunk} times a chunk, '
+              f'{time.perf_counter() - start:.1f} s')
+        print(f'variance fractions {np.round(solver.varianceFraction().values, 4)}')
+
+
+if __name__ == '__main__':
+    bench_eof(**R1)
+    bench_eof(**ERA5)
+    bench_eof_streaming(**ERA5, ntime=int(sys.argv[1]) if len(sys.argv) > 1 else 1461)
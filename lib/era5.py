@@ -1,8 +1,24 @@
-import xarray as xr
+from functools import partial
+
+import numpy as np
 import pandas as pd
+import xarray as xr
+
+from lib.cache import DatasetCache
+from lib.longitude import arc_positions, take
+from lib.opendap import OpendapSession
+from lib.reanalysis import archive
 
 RDA_THREDDS_URL = 'https://rda.ucar.edu/thredds/dodsC/files/g'
 
+PL_MONTHLY = ('ds633.1_nc', 'e5.moda.an.pl')
+PL_DAILY = ('ds633.0', 'e5.oper.an.pl')
+
+# Bundles (see era5_pl_bundle) are cached locally after their first pull, keyed by
+# the variables, period and subset; see lib.cache for the location and size limit.
+USE_CACHE = True
+CACHE = DatasetCache.shared()
+
 
 class _ERA5Variable:
     def __init__(self, code):
@@ -19,33 +35,153 @@ class PL_VARS:
     RH = _ERA5Variable(code='128_157_r.ll025sc')
 
 
-def era5_pl_monthly(year, var, session):
-    category = 'e5.moda.an.pl'
-    catalog = 'ds633.1_nc'
-    base_url = f'{RDA_THREDDS_URL}/{catalog}/{category}'
-    url = f'{base_url}/{year}/{category}.{var.code}.{year}010100_{year}120100.nc'
-    return open_dataset(url, session)
+# Winds and temperature for back trajectories: the bundle has U, V, W and T, so it
+# can be passed as each of u, v, w and T.
+TRAJECTORY_VARS = (PL_VARS.U_WIND, PL_VARS.V_WIND, PL_VARS.OMEGA, PL_VARS.TEMPERATURE)
+
+
+# `bbox` (west, east, north, south), `levels` (hPa) and, for the hourly analyses,
+# `hours` (of the day, UTC) restrict the data to a region, a few levels and a few
+# analysis times. They are applied before anything is read, so only that part of
+# the grid is fetched from RDA (see lib.opendap.report for the bytes) or the local
+# archive. The box may cross the 0/360 seam, e.g. (-130, -60, 55, 20) over North
+# America; its longitudes come back continuous from west.
+def era5_pl_monthly(year, var, session, bbox=None, levels=None):
+    subset = partial(_pl_positions, bbox=bbox, levels=levels)
+    archived = _read_archived(PL_MONTHLY, var, f'{year}-01-01', f'{year}-12-01', subset)
+    if archived is not None:
+        return archived
+    return open_dataset(pl_monthly_url(year, var), session, hyperslab=lambda ds: _indexers(*subset(ds)),
+                        preprocess=partial(_unwrap, bbox=bbox))
 
 
-def era5_pl_daily(when, var, session):
-    category = 'e5.oper.an.pl'
-    catalog = 'ds633.0'
+def era5_pl_daily(when, var, session, bbox=None, levels=None, hours=None):
+    days = [when] if not isinstance(when, (list, tuple, set)) else sorted(when)
+    days = pd.DatetimeIndex([pd.Timestamp(t).floor('D') for t in days])
+    subset = partial(_pl_positions, days=days, bbox=bbox, levels=levels, hours=hours)
+    archived = _read_archived(PL_DAILY, var, days[0], days[-1] + pd.Timedelta(23, 'h'), subset)
+    if archived is not None:
+        return archived
+    return open_pl_daily(when, var, session, hyperslab=lambda ds: _indexers(*subset(ds)),
+                         preprocess=partial(_unwrap, bbox=bbox))
 
-    def _generate_daily_url(t):
-        t = pd.Timestamp(t)
-        base_url = f'{RDA_THREDDS_URL}/{catalog}/{category}'
-        return f'{base_url}/{t:%Y%m}/{category}.{var.code}.{t:%Y%m%d}00_{t:%Y%m%d}23.nc'
 
+# The hourly analyses of several `variables` (e.g. TRAJECTORY_VARS) from `start` to
+# `end` (inclusive) as one Dataset, aligned on the times and grid they share, with
+# `bbox`, `levels` and `hours` as for era5_pl_daily. Variables the archive covers
+# are read from it, and the day files of all the others are opened concurrently
+# in one pull.
+def era5_pl_bundle(variables, start, end, session, bbox=None, levels=None, hours=None):
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    if not USE_CACHE:
+        return _pl_bundle(variables, start, end, session, bbox, levels, hours)
+
+    return CACHE.get(lambda: _pl_bundle(variables, start, end, session, bbox, levels, hours).load(),
+                     source='era5', product='pl_bundle', codes=[var.code for var in variables],
+                     start=start, end=end, bbox=bbox, levels=levels, hours=hours)
+
+
+def _pl_bundle(variables, start, end, session, bbox=None, levels=None, hours=None):
+    days = pd.date_range(start.floor('D'), end.floor('D'), freq='D')
+    subset = partial(_pl_positions, days=days, bbox=bbox, levels=levels, hours=hours)
+
+    datasets, remote = [], []
+    for var in variables:
+        archived = _read_archived(PL_DAILY, var, days[0], days[-1] + pd.Timedelta(23, 'h'), subset)
+        if archived is not None:
+            datasets.append(archived)
+        else:
+            remote.append(var)
+    if remote:
+        urls = [pl_daily_url(t, var) for var in remote for t in days]
+        datasets.append(OpendapSession.of(session).open_many(urls, hyperslab=lambda ds: _indexers(*subset(ds)),
+                                                             preprocess=partial(_unwrap, bbox=bbox)))
+
+    bundle = xr.merge(datasets, join='inner', combine_attrs='override')
+    return bundle.sel(time=slice(start, end))
+
+
+# Opens the RDA daily file(s) for `when` (a day or list of days) directly, several
+# days at once. `session` is a requests.Session with RDA credentials or an
+# OpendapSession (see lib.opendap for pooling, retries and `hyperslab`).
+def open_pl_daily(when, var, session, hyperslab=None, preprocess=None):
     if not isinstance(when, (list, tuple, set)):
-        url = _generate_daily_url(when)
-        return open_dataset(url, session)
+        return OpendapSession.of(session).open(pl_daily_url(when, var), hyperslab=hyperslab, preprocess=preprocess)
 
-    urls = [_generate_daily_url(t) for t in when]
-    stores = [xr.backends.PydapDataStore.open(file, session=session) for file in urls]
-    return xr.open_mfdataset(stores)
+    urls = [pl_daily_url(t, var) for t in when]
+    return OpendapSession.of(session).open_many(urls, hyperslab=hyperslab, preprocess=preprocess)
+
+
+def pl_monthly_url(year, var):
+    catalog, category = PL_MONTHLY
+    base_url = f'{RDA_THREDDS_URL}/{catalog}/{category}'
+    return f'{base_url}/{year}/{category}.{var.code}.{year}010100_{year}120100.nc'
+
+
+def pl_daily_url(t, var):
+    catalog, category = PL_DAILY
+    t = pd.Timestamp(t)
+    base_url = f'{RDA_THREDDS_URL}/{catalog}/{category}'
+    return f'{base_url}/{t:%Y%m}/{category}.{var.code}.{t:%Y%m%d}00_{t:%Y%m%d}23.nc'
+
+
+# name of a variable's store in the local archive, e.g. 'e5.oper.an.pl/128_129_z.ll025sc'
+def archive_name(product, var):
+    catalog, category = product
+    return f'{category}/{var.code}'
 
 
 def open_dataset(url, session, **kwargs):
-    print('Opening dataset for ' + url)
-    store = xr.backends.PydapDataStore.open(url, session=session)
-    return xr.open_dataset(store, **kwargs)
+    return OpendapSession.of(session).open(url, **kwargs)
+
+
+# Positional indexers of ERA5 data for the `days`, `hours`, `levels` and `bbox`
+# asked for, except for longitude, which comes separately as positions along the
+# grid and their continuous longitudes (None for all of them).
+def _pl_positions(ds, days=None, bbox=None, levels=None, hours=None):
+    indexers = {}
+    times = ds.indexes['time']
+    if days is not None or hours is not None:
+        keep = np.ones(len(times), dtype=bool)
+        if days is not None:
+            keep &= times.floor('D').isin(days)
+        if hours is not None:
+            keep &= times.hour.isin(np.atleast_1d(hours))
+        indexers['time'] = np.flatnonzero(keep)
+    if levels is not None:
+        levels = np.atleast_1d(levels)
+        positions = ds.indexes['level'].get_indexer(levels)
+        if (positions < 0).any():
+            raise ValueError(f'Levels {list(levels[positions < 0])} are not in {list(ds.indexes["level"])}')
+        indexers['level'] = positions
+
+    if bbox is None:
+        return indexers, None
+    west, east, north, south = bbox
+    indexers['latitude'] = ds.indexes['latitude'].slice_indexer(north, south)
+    return indexers, arc_positions(ds['longitude'].values, west, east)
+
+
+# `var` from the local archive between `start` and `end`, subset by `subset` (see
+# _pl_positions), or None if the archive doesn't cover it.
+def _read_archived(product, var, start, end, subset):
+    archived = archive.read('era5', archive_name(product, var), start, end, route=lambda ds: _indexers(*subset(ds)))
+    return None if archived is None else _take(archived, *subset(archived))
+
+
+def _indexers(indexers, lon):
+    return indexers if lon is None else {**indexers, 'longitude': lon[0]}
+
+
+def _take(ds, indexers, lon):
+    return ds.isel(indexers) if lon is None else take(ds, *lon, londim='longitude', **indexers)
+
+
+# Relabels the longitudes of a box read from the remote grid continuously from its
+# west edge, as take does for archived data; they are already in arc order.
+def _unwrap(ds, bbox=None):
+    if bbox is None:
+        return ds
+    west, east, north, south = bbox
+    _, lons = arc_positions(ds['longitude'].values, west, east)
+    return ds.assign_coords(longitude=ds['longitude'].copy(data=lons.astype(ds['longitude'].dtype)))
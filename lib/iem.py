@@ -0,0 +1,133 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import requests
+import urllib3
+
+from lib import cache
+
+# Bulk downloads from the IEM (Iowa Environmental Mesonet) CSV services behind
+# lib.obs. A pull is split into tasks (e.g. one per station and year) fetched by up
+# to MAX_WORKERS threads, which between them start at most REQUESTS_PER_SECOND
+# requests a second, as IEM throttles heavier use. A failed request (dropped
+# connection, 429/5xx) is retried MAX_RETRIES times, waiting whatever the server's
+# Retry-After asks for, or else RETRY_BACKOFF * 2 ** attempt seconds. Responses are
+# parsed as they stream in, CSV_CHUNKSIZE rows at a time.
+MAX_WORKERS = 4
+REQUESTS_PER_SECOND = 2.
+MAX_RETRIES = 5
+RETRY_BACKOFF = 2.
+RETRY_STATUS = (429, 500, 502, 503, 504)
+TIMEOUT = 300
+CSV_CHUNKSIZE = 50000
+
+
+# Spaces out calls to wait() from any number of threads to at most `per_second`.
+class RateLimiter(object):
+    def __init__(self, per_second=None):
+        per_second = REQUESTS_PER_SECOND if per_second is None else per_second
+        self.interval = 1. / per_second if per_second else 0.
+        self._next = 0.
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(start - now)
+
+
+# Fetches `tasks`, a dict of {key: url}, into DataFrames (parsed with the
+# pd.read_csv keyword arguments, e.g. dtype, so every task comes back with the same
+# column types) and returns them concatenated in task order.
+#
+# With `directory`, each finished task is kept there as <key>.parquet, so a pull
+# that is interrupted or partly fails can be resumed by calling download again
+# with the same tasks: only the missing ones, and those in `refresh`, are fetched.
+# Offline (see lib.cache.OFFLINE) only kept tasks are read, and any missing one
+# raises FileNotFoundError.
+def download(tasks, directory=None, session=None, max_workers=None, rate=None, refresh=(), offline=None,
+             **read_csv_kwargs):
+    session = session or requests.Session()
+    limiter = RateLimiter(rate)
+    max_workers = max_workers or MAX_WORKERS
+    offline = cache.OFFLINE if offline is None else offline
+    refresh = set(refresh)
+    fetched = []
+
+    def fetch(key):
+        part = os.path.join(directory, f'{key}.parquet') if directory else None
+        if part and os.path.exists(part) and (offline or key not in refresh):
+            return _read_parquet(part)
+        if offline:
+            raise FileNotFoundError(f'{key} is not in {directory} and offline mode is on')
+
+        df = fetch_csv(tasks[key], session, limiter, **read_csv_kwargs)
+        fetched.append(key)
+        if part:
+            os.makedirs(os.path.dirname(part), exist_ok=True)
+            tmp_path = f'{part}.{os.getpid()}.{threading.get_ident()}.tmp'
+            df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, part)
+        return df
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        frames = list(pool.map(fetch, tasks))
+    result = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    if fetched:
+        print(f'Downloaded {len(fetched)} of {len(tasks)} requests ({len(result)} rows) '
+              f'in {time.perf_counter() - start:.1f} s')
+    return result
+
+
+# One CSV request, retried as described above; `limiter` (a RateLimiter) is waited
+# on before every attempt.
+def fetch_csv(url, session=None, limiter=None, **read_csv_kwargs):
+    session = session or requests.Session()
+    for attempt in range(MAX_RETRIES + 1):
+        if limiter is not None:
+            limiter.wait()
+        try:
+            with session.get(url, stream=True, timeout=TIMEOUT) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                return _read_csv(response.raw, **read_csv_kwargs)
+        except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            if attempt == MAX_RETRIES or (status is not None and status not in RETRY_STATUS):
+                raise
+            wait = _retry_after(e) or RETRY_BACKOFF * 2 ** attempt
+            print(f'Retrying {url} in {wait:.0f} s after error: {e}')
+            time.sleep(wait)
+
+
+def _read_csv(stream, **read_csv_kwargs):
+    try:
+        chunks = list(pd.read_csv(stream, chunksize=CSV_CHUNKSIZE, **read_csv_kwargs))
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame()
+    return pd.concat(chunks, ignore_index=True)
+
+
+# Parquet gives back missing strings as None, CSV parsing as NaN
+def _read_parquet(path):
+    df = pd.read_parquet(path)
+    strings = df.columns[df.dtypes == object]
+    df[strings] = df[strings].where(df[strings].notna(), np.nan)
+    return df
+
+
+# seconds asked for by a 429/503 response's Retry-After header, if any
+def _retry_after(e):
+    response = getattr(e, 'response', None)
+    value = response.headers.get('Retry-After') if response is not None else None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
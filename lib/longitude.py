@@ -0,0 +1,86 @@
+import numpy as np
+import xarray as xr
+
+# Longitude conventions: 0-360 data (NCEP, ERA5 on RDA) vs. -180-180 maps and
+# station coordinates. Data is re-centered by rolling whole columns, and boxes are
+# selected as positions along the grid's own longitudes, so an area query only
+# ever reads the columns it needs, and a box crossing the dateline or the 0/360
+# seam (e.g. the Aleutians, 170 to 205 or 170 to -155) comes back as one
+# continuous run of longitudes.
+
+
+# Longitudes in (-180, 180]
+def to_180(lon):
+    lon = np.mod(lon, 360)
+    return np.where(lon > 180, lon - 360, lon)
+
+
+# Longitudes in [0, 360)
+def to_360(lon):
+    return np.mod(lon, 360)
+
+
+CONVENTIONS = {'180': to_180, '360': to_360}
+
+
+# `ds` with its longitudes in `convention` ('180' or '360') and ascending, by one
+# roll of the grid columns. Rolling is a pair of slices, so dask-backed data stays
+# lazy. Grids that aren't a rotation of an ascending grid fall back to sorting.
+def recenter(ds, convention='180', londim='lon'):
+    positions, lons = recentered_positions(ds[londim].values, convention)
+    shift = -int(positions[0]) if len(positions) else 0
+    if not np.array_equal(positions, np.roll(np.arange(len(positions)), shift)):
+        return ds.isel({londim: positions}).assign_coords({londim: ds[londim][positions].copy(data=lons)})
+
+    rolled = ds.roll({londim: shift}, roll_coords=True)
+    return rolled.assign_coords({londim: rolled[londim].copy(data=lons)})
+
+
+# Positions that put `lon` in ascending order in `convention`, and the
+# re-centered longitudes.
+def recentered_positions(lon, convention='180'):
+    if convention not in CONVENTIONS:
+        raise ValueError(f'Unknown longitude convention {convention!r}, expected one of {list(CONVENTIONS)}')
+    lons = CONVENTIONS[convention](np.asarray(lon, dtype=np.float64))
+    positions = np.argsort(lons, kind='stable')
+    return positions, lons[positions]
+
+
+# Positions along `lon` of the longitudes on the arc east from `west` to `east`
+# (inclusive), in that order, and those longitudes unwrapped to run continuously
+# from `west`. The bounds can be in either convention; an arc of 360 degrees or
+# more is the whole circle.
+def arc_positions(lon, west, east):
+    lon = np.asarray(lon, dtype=np.float64)
+    span = 360. if abs(east - west) >= 360 else np.mod(east - west, 360)
+    offset = np.mod(lon - west, 360)
+    positions = np.flatnonzero(offset <= span)
+    positions = positions[np.argsort(offset[positions], kind='stable')]
+    # add whole turns to the original values rather than west + offset, so grid
+    # longitudes come back exactly
+    turns = np.round((west + offset[positions] - lon[positions]) / 360)
+    return positions, lon[positions] + 360 * turns
+
+
+# `ds` restricted to the longitudes between `west` and `east` (see arc_positions)
+# along with any other positional `indexers`, labelled with the continuous
+# longitudes.
+def select_lon(ds, west, east, londim='lon', **indexers):
+    positions, lons = arc_positions(ds[londim].values, west, east)
+    return take(ds, positions, lons, londim, **indexers)
+
+
+# ds.isel(**indexers) plus the longitude columns at `positions`, relabelled `lons`.
+# Each contiguous run of positions is read as a slice, so a lazily opened file or
+# OPeNDAP dataset only fetches those columns; a box across the grid's seam is two
+# slices joined end to end.
+def take(ds, positions, lons, londim='lon', **indexers):
+    positions = np.asarray(positions)
+    runs = np.split(positions, np.flatnonzero(np.diff(positions) != 1) + 1)
+    if len(positions) == 0 or len(runs) > 2:
+        result = ds.isel({**indexers, londim: positions})
+    else:
+        pieces = [ds.isel({**indexers, londim: slice(run[0], run[-1] + 1)}) for run in runs]
+        result = pieces[0] if len(pieces) == 1 else xr.concat(
+            pieces, dim=londim, data_vars='minimal', coords='minimal', compat='override', join='override')
+    return result.assign_coords({londim: result[londim].copy(data=np.asarray(lons, dtype=result[londim].dtype))})
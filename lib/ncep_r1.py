@@ -1,14 +1,50 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from ftplib import FTP
 
 import numpy as np
 import pandas as pd
+import requests
 import xarray as xr
 
 import os
 
+from lib.cache import NETCDF_LOCK, DatasetCache
+from lib.climatology import anomalies, ltm_for_years
+from lib.longitude import arc_positions, recenter, recentered_positions, take
+from lib.reanalysis import archive
+
 BASE_URI = 'http://www.esrl.noaa.gov/psd/thredds/dodsC/Datasets'
 
+# Year files are cached locally after their first pull, keyed by the subset query;
+# see lib.cache for the location, size limit and offline mode. PSL appends to the
+# current year's file daily, so a year cached before it was complete (before Jan 1
+# of the next plus COMPLETE_AFTER) is pulled again once its copy is older than
+# REFRESH_AFTER.
+USE_CACHE = True
+CACHE = DatasetCache.shared()
+REFRESH_AFTER = pd.Timedelta(6, 'h')
+COMPLETE_AFTER = pd.Timedelta(2, 'D')
+
+# Years covered by the local Zarr archive (see lib.reanalysis.archive) are read
+# from it instead.
+USE_ARCHIVE = True
+
+# Years are fetched concurrently by up to MAX_WORKERS threads; a year that fails
+# transiently (dropped connection, timeout, 429/5xx response or netCDF DAP
+# failure) is retried MAX_RETRIES times, waiting RETRY_BACKOFF * 2 ** attempt
+# seconds between. Other errors, such as a missing file or an offline cache miss,
+# are raised straight away.
+MAX_WORKERS = 8
+MAX_RETRIES = 3
+RETRY_BACKOFF = 2.
+RETRY_STATUS = (429, 500, 502, 503, 504)
+RETRY_MESSAGES = ('DAP failure', 'DAP server error')
+
+# time chunk length of the dask arrays returned with lazy=True
+LAZY_TIME_CHUNK = 366
+
 
 def ftp_cdc_esrl_file(file, email):
     ftp_url = 'ftp.cdc.noaa.gov'
@@ -26,31 +62,31 @@ def export_file_for_ftp(ser, dest):
     ser.to_csv(dest, index=False, header=ser.shape)
 
 
-def dailyavg(product, query, with_shiftgrid=False):
+# With lazy=True, the result is backed by dask arrays chunked along time (see
+# LAZY_TIME_CHUNK), and nothing beyond the cache fill is read until computed.
+def dailyavg(product, query, with_shiftgrid=False, lazy=False):
     all_dailyavg_years = range(1948, pd.Timestamp.now().year)
-    years = _coerce_to_list(query.get('year', all_dailyavg_years))
+    compiled = Query.compile(query)
+    years = compiled.years(all_dailyavg_years)
 
     load_func = partial(_load_ncep, folder='ncep.reanalysis.dailyavgs',
-                        product=product, query=query,
-                        with_shiftgrid=with_shiftgrid)
-    results = []
-    for yr in years:
-        results.append(load_func(yr))
+                        product=product, query=compiled,
+                        with_shiftgrid=with_shiftgrid, lazy=lazy)
+    results = _load_years(years, load_func)
 
     print(f'Combining data from years for {product}')
     return xr.concat(results, dim='time')
 
 
-def daily4x(product, query, with_shiftgrid=False):
+def daily4x(product, query, with_shiftgrid=False, lazy=False):
     all_daily4x_years = range(1948, pd.Timestamp.now().year)
-    years = _coerce_to_list(query.get('year', all_daily4x_years))
+    compiled = Query.compile(query)
+    years = compiled.years(all_daily4x_years)
 
     load_func = partial(_load_ncep, folder='ncep.reanalysis',
-                        product=product, query=query,
-                        with_shiftgrid=with_shiftgrid)
-    results = []
-    for yr in years:
-        results.append(load_func(yr))
+                        product=product, query=compiled,
+                        with_shiftgrid=with_shiftgrid, lazy=lazy)
+    results = _load_years(years, load_func)
 
     print(f'Combining data from years for {product}')
     return xr.concat(results, dim='time')
@@ -64,81 +100,227 @@ def dailyavg_ltm(product, query, with_shiftgrid=False):
 
     years = _coerce_to_list(query.get('year', []))
     if years:
-        orig_times = result.time.values
-        concat_datasets = []
-        for year in years:
-            ds_for_year = result.copy()
-            newtimes = np.array([pd.Timestamp(year=year,
-                                              month=t.month,
-                                              day=t.day,
-                                              hour=t.hour,
-                                              minute=t.minute) for t in orig_times])
-            ds_for_year['time'] = newtimes
-            concat_datasets.append(ds_for_year)
-
         print(f'Creating long-term mean timeseries of {product}')
-        return xr.concat(concat_datasets, dim='time')
+        return ltm_for_years(result, years)
 
     return result
 
 
-def _load_ncep(year, folder, product, query, with_shiftgrid):
+# Daily mean anomalies from the 1981-2010 daily climatology, aligned by calendar
+# day without building a per-year copy of the climatology.
+def dailyavg_anom(product, query, with_shiftgrid=False, lazy=False):
+    data = dailyavg(product, query, with_shiftgrid=with_shiftgrid, lazy=lazy)
+    ltm_query = {k: v for k, v in query.items() if k in ('pressure_level', 'area')}
+    ltm = dailyavg_ltm(product, ltm_query, with_shiftgrid=with_shiftgrid)
+    return anomalies(data, ltm)
+
+
+# Runs load_func for each year on a thread pool, returning results in year order
+# once all are done, and prints how long each year took.
+def _load_years(years, load_func):
+    def timed_load(yr):
+        start = time.perf_counter()
+        result = _with_retries(load_func, yr)
+        return result, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        loaded = list(pool.map(timed_load, years))
+
+    for yr, (_, secs) in zip(years, loaded):
+        print(f'Loaded {yr} in {secs:.1f} s')
+    return [result for result, _ in loaded]
+
+
+def _with_retries(func, *args):
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return func(*args)
+        except (OSError, RuntimeError) as e:
+            if attempt == MAX_RETRIES or not _transient(e):
+                raise
+            wait = RETRY_BACKOFF * 2 ** attempt
+            print(f'Retrying {args} in {wait:.0f} s after error: {e}')
+            time.sleep(wait)
+
+
+# whether `e` (or the error it was raised from) is worth retrying
+def _transient(e):
+    while e is not None:
+        if isinstance(e, (FileNotFoundError, PermissionError, IsADirectoryError)):
+            return False
+        if isinstance(e, (ConnectionError, TimeoutError, requests.ConnectionError, requests.Timeout)):
+            return True
+        status = getattr(getattr(e, 'response', None), 'status_code', None)
+        if status is not None:
+            return status in RETRY_STATUS
+        if any(message in str(e) for message in RETRY_MESSAGES):
+            return True
+        e = e.__cause__
+    return False
+
+
+def _load_ncep(year, folder, product, query, with_shiftgrid, lazy=False):
+    chunks = {'time': LAZY_TIME_CHUNK} if lazy else None
+
+    if USE_ARCHIVE and isinstance(year, int):
+        end = pd.Timestamp(year=year, month=12, day=31, hour=0 if folder.endswith('dailyavgs') else 18)
+        compiled = Query.compile(query)
+        archived = archive.read('ncep_r1', f'{folder}/{product}', f'{year}-01-01', end,
+                                route=partial(compiled.indexers, with_shiftgrid=with_shiftgrid))
+        if archived is not None:
+            ds = compiled.apply(archived, with_shiftgrid=with_shiftgrid)
+            return ds if lazy else ds.load()
+
+    def open_remote(chunks=None):
+        ds = open_year(year, folder, product, chunks=chunks)
+        return select(ds, query, with_shiftgrid=with_shiftgrid)
+
+    if not USE_CACHE:
+        ds = open_remote(chunks)
+        return ds if lazy else ds.load()
+
+    subset = {k: v for k, v in Query.compile(query).raw.items() if k != 'year'}
+    complete = None
+    if isinstance(year, (int, np.integer)):
+        complete = pd.Timestamp(year=int(year) + 1, month=1, day=1) + COMPLETE_AFTER
+    path = CACHE.get_path(lambda: open_remote().load(), complete, REFRESH_AFTER, source='ncep_r1', folder=folder,
+                          product=product, year=year, query=subset, with_shiftgrid=with_shiftgrid)
+    with NETCDF_LOCK:
+        return xr.open_dataset(path, chunks=chunks)
+
+
+# Lazily opens one year file of `product` (e.g. 'pressure/hgt') in `folder`.
+def open_year(year, folder, product, chunks=None):
     url = f'{BASE_URI}/{folder}/{product}.{year}.nc'
-    ds = xr.open_dataset(url)
-    ds = select(ds, query, with_shiftgrid=with_shiftgrid)
-    # print(f'loaded for year {year}')
-    return ds
+    # netCDF4 reads hold a process-wide lock in xarray, which would serialize the
+    # threads in _load_years; pydap fetches OPeNDAP over plain HTTP without it
+    if url.startswith('http'):
+        return xr.open_dataset(url, engine='pydap', chunks=chunks)
+    with NETCDF_LOCK:
+        return xr.open_dataset(url, chunks=chunks)
 
 
 def select(data, query, with_shiftgrid=False):
-    kw = {}
-
-    level_param = query.get('pressure_level', [])
-    if level_param:
-        kw['level'] = level_param
-
-    months = _coerce_to_list(query.get('month', []))
-    days = _coerce_to_list(query.get('day', []))
-    hours = _coerce_to_list(query.get('hour', []))
-
-    if all([not months, not days, not hours]):
-        pass
-    else:
-        time_query = np.in1d([1], [1])
-        if months:
-            time_query &= np.in1d(data['time.month'], months)
-        if days:
-            time_query &= np.in1d(data['time.day'], days)
-        if hours:
-            time_query &= np.in1d(data['time.hour'], hours)
-
-        kw['time'] = time_query
-
-    result = data.sel(**kw)
-
-    if with_shiftgrid:
-        result = shiftgrid(result)
-
-    area_param = query.get('area', None)
-    if area_param:
-        area_kw = {}
-        north, west, south, east = map(float, area_param.split('/'))
-        lat_query = slice(north, south)
-        lon_query = slice(west, east)
-        area_kw['lat'] = lat_query
-        area_kw['lon'] = lon_query
-        return result.sel(**area_kw)
-
-    return result
-
-
+    return Query.compile(query).apply(data, with_shiftgrid=with_shiftgrid)
+
+
+# A `query` dict parsed once into the pieces select() needs. Recognized keys:
+#   year            year or list of years (which files to load)
+#   pressure_level  level or list of levels; a single level drops the dimension
+#   month, day, hour  value or list of values each time component must match
+#   season          'DJF', 'MAM', 'JJA', 'SON' or a list of them; adds their months
+#   dates           list of calendar days to keep
+#   date_range      (start, end) of times to keep, inclusive
+#   area            'north/west/south/east'; west to east may cross the dateline or
+#                   the 0/360 seam (e.g. '65/170/45/205' or '65/170/45/-155')
+# All of the time, level and area selection is turned into positional indexers and
+# applied as one isel (one per contiguous run of longitudes, see lib.longitude).
+class Query(object):
+    SEASONS = {'DJF': (12, 1, 2), 'MAM': (3, 4, 5), 'JJA': (6, 7, 8), 'SON': (9, 10, 11)}
+
+    @classmethod
+    def compile(cls, query):
+        return query if isinstance(query, cls) else cls(query)
+
+    def __init__(self, query):
+        self.raw = dict(query)
+        self.level = query.get('pressure_level', None) or None
+
+        self.months = list(_coerce_to_list(query.get('month', [])))
+        for season in _coerce_to_list(query.get('season', [])):
+            self.months.extend(self.SEASONS[season.upper()])
+        self.days = _coerce_to_list(query.get('day', []))
+        self.hours = _coerce_to_list(query.get('hour', []))
+
+        dates = query.get('dates', None)
+        self.dates = None if dates is None else np.unique(pd.to_datetime(list(dates)).values.astype('datetime64[D]'))
+        date_range = query.get('date_range', None)
+        self.date_range = None if date_range is None else tuple(map(pd.Timestamp, date_range))
+
+        area = query.get('area', None)
+        self.area = tuple(map(float, area.split('/'))) if area else None
+
+    # years this query can touch, out of `default`
+    def years(self, default):
+        if 'year' in self.raw:
+            return _coerce_to_list(self.raw['year'])
+        years = set(default)
+        if self.dates is not None:
+            years &= set(pd.DatetimeIndex(self.dates).year)
+        if self.date_range is not None:
+            start, end = self.date_range
+            years &= set(range(start.year, end.year + 1))
+        return sorted(years)
+
+    def apply(self, data, with_shiftgrid=False):
+        indexers, lon = self.positions(data, with_shiftgrid)
+        if lon is None:
+            return data.isel(**indexers)
+        return take(data, *lon, **indexers)
+
+    # Positional indexers for the time, level and lat selection, and the lon
+    # (positions, longitudes) to take, or None to keep the lons as they are.
+    def positions(self, data, with_shiftgrid=False):
+        indexers = {}
+
+        time_index = self.time_index(data.indexes['time'])
+        if time_index is not None:
+            indexers['time'] = time_index
+
+        if self.level is not None:
+            if isinstance(self.level, (list, tuple, np.ndarray)):
+                indexers['level'] = data.indexes['level'].get_indexer(self.level)
+            else:
+                indexers['level'] = data.indexes['level'].get_loc(self.level)
+            if np.any(np.asarray(indexers['level']) < 0):
+                raise KeyError(f'pressure_level {self.level} not all found in {data.level.values}')
+
+        if self.area is not None:
+            north, west, south, east = self.area
+            lat = data['lat'].values
+            indexers['lat'] = np.flatnonzero((lat >= south) & (lat <= north))
+            # with shiftgrid, a box given in 0-360 comes back in -180-180 terms
+            if with_shiftgrid and west > 180:
+                west, east = west - 360, east - 360
+            return indexers, arc_positions(data['lon'].values, west, east)
+
+        if with_shiftgrid:
+            return indexers, recentered_positions(data['lon'].values, '180')
+
+        return indexers, None
+
+    # all of positions() as plain isel indexers, e.g. for archive.read's routing
+    def indexers(self, data, with_shiftgrid=False):
+        indexers, lon = self.positions(data, with_shiftgrid)
+        if lon is not None:
+            indexers['lon'] = lon[0]
+        return indexers
+
+    # positions of the times matching the query, or None to keep them all
+    def time_index(self, times):
+        mask = None
+
+        def restrict(component_mask):
+            return component_mask if mask is None else mask & component_mask
+
+        for values, component in ((self.months, 'month'), (self.days, 'day'), (self.hours, 'hour')):
+            if values:
+                mask = restrict(np.isin(np.asarray(getattr(times, component)), values))
+
+        if self.dates is not None:
+            days = np.asarray(times.values, dtype='datetime64[D]')
+            mask = restrict(np.isin(days, self.dates))
+        if self.date_range is not None:
+            start, end = self.date_range
+            mask = restrict((times >= start) & (times <= end))
+
+        return None if mask is None else np.flatnonzero(mask)
+
+
+# Longitudes in -180-180, re-centered with one roll of the grid rather than a sort.
+# The result is always new, so `copy` is only kept for existing callers.
 def shiftgrid(ds, londim='lon', copy=False):
-    shifted = ds.copy() if copy else ds
-    londata = shifted[londim].values
-    londata_shifted = np.where((londata >= -180) & (londata <= 180), londata, -360 + londata)
-    shifted[londim] = londata_shifted
-    shifted = shifted.sortby(londim)
-    return shifted
+    return recenter(ds, '180', londim=londim)
 
 
 def _coerce_to_list(val):
@@ -1,5 +1,11 @@
+import os
+import time
+
+import numpy as np
 import pandas as pd
-from config import get_resource
+
+from lib import iem
+from lib.stations import catalog
 
 ASOS_SERVICE = 'http://mesonet.agron.iastate.edu/cgi-bin/request/asos.py?'
 HR_PRECIP_SERVICE = 'https://mesonet.agron.iastate.edu/cgi-bin/request/hourlyprecip.py?'
@@ -7,6 +13,25 @@ DAILY_SUMMARY_SERVICE = 'https://mesonet.agron.iastate.edu/cgi-bin/request/daily
 
 DEBUG = False
 
+# hourly_precip and daily_summary read through a local Parquet store of whole
+# station-years at OBS_STORE_DIR/<service>/<network>/<station>/<year>.parquet: only
+# years not stored yet are fetched, plus years stored before they were complete
+# (before Jan 1 of the next year plus COMPLETE_AFTER, for late reports) once their
+# copy is older than REFRESH_AFTER. With lib.cache.OFFLINE set nothing is fetched,
+# and years missing from the store raise FileNotFoundError.
+USE_STORE = True
+OBS_STORE_DIR = os.getenv('WEATHER_OBS_DIR', os.path.join(os.path.expanduser('~'), 'weather-obs'))
+REFRESH_AFTER = pd.Timedelta(6, 'h')
+COMPLETE_AFTER = pd.Timedelta(2, 'D')
+
+# Column types of ASOS observations, so every station-year of a bulk pull parses
+# the same way whatever it happens to contain (trace amounts come as 0.0001)
+ASOS_STRING_COLUMNS = ['station', 'skyc1', 'skyc2', 'skyc3', 'skyc4', 'wxcodes', 'peak_wind_time', 'metar']
+ASOS_FLOAT_COLUMNS = ['lon', 'lat', 'tmpf', 'dwpf', 'relh', 'drct', 'sknt', 'p01i', 'alti', 'mslp', 'vsby',
+                      'gust', 'skyl1', 'skyl2', 'skyl3', 'skyl4', 'ice_accretion_1hr', 'ice_accretion_3hr',
+                      'ice_accretion_6hr', 'peak_wind_gust', 'peak_wind_drct', 'feel', 'snowdepth']
+ASOS_DTYPES = {**{col: str for col in ASOS_STRING_COLUMNS}, **{col: 'float64' for col in ASOS_FLOAT_COLUMNS}}
+
 
 def _parse_args(station, startts, endts):
     station_result = station
@@ -20,16 +45,35 @@ def _parse_args(station, startts, endts):
     return station_result, pd.Timestamp(startts), pd.Timestamp(endts)
 
 
-def asos_raw(station, startts, endts):
+# Requested a station and year at a time, concurrently (see lib.iem). With
+# `directory`, finished station-years are kept there and an interrupted pull
+# resumes where it stopped when called again.
+def asos_raw(station, startts, endts, directory=None, session=None):
     stations, startts, endts = _parse_args(station, startts, endts)
 
-    url = ASOS_SERVICE + 'data=all&tz=Etc/UTC&format=onlycomma&latlon=yes&'
+    tasks = {}
+    for st in stations:
+        for start, end in _year_ranges(startts, endts):
+            url = _asos_url(st, start, end)
+            _print_if_debug(f'Getting data from url: {url}')
+            tasks[f'{st}/{start:%Y%m%d}_{end:%Y%m%d}'] = url
+
+    return iem.download(tasks, directory, session, dtype=ASOS_DTYPES, parse_dates=['valid'], na_values='M')
+
+
+def _asos_url(station, startts, endts):
+    url = ASOS_SERVICE + 'data=all&tz=Etc/UTC&format=onlycomma&latlon=yes&trace=0.0001&'
     url += f'year1={startts:%Y}&month1={startts:%-m}&day1={startts:%-d}&'
     url += f'year2={endts:%Y}&month2={endts:%-m}&day2={endts:%-d}&'
-    url += '&'.join([f'station={st}' for st in stations])
+    return url + f'station={station}'
 
-    _print_if_debug(f'Getting data from url: {url}')
-    return pd.read_csv(url, parse_dates=['valid'], na_values='M')
+
+# (start, end) dates splitting startts-endts at each new year
+def _year_ranges(startts, endts):
+    bounds = [startts.floor('D')]
+    bounds += [pd.Timestamp(year=year, month=1, day=1) for year in range(startts.year + 1, endts.year + 1)]
+    bounds += [endts.floor('D')]
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start < end or len(bounds) == 2]
 
 
 def hourly_precip(station, startts, endts, filter_measurable=True, reindex=True, sort=True):
@@ -46,11 +90,7 @@ def hourly_precip(station, startts, endts, filter_measurable=True, reindex=True,
     if filter_measurable:
         result = result[result.precip_in >= 0.01]
     else:
-        resampled_by_st = []
-        for st in result.station.unique():
-            df = result[result.station == st]
-            resampled_by_st.append(_resample(df, startts, endts))
-        result = pd.concat(resampled_by_st)
+        result = _fill_hours(result, startts, endts)
 
     if sort:
         by = ['valid', 'station'] if sort is True else sort
@@ -74,50 +114,102 @@ def daily_summary(station, startts, endts):
     return result
 
 
-def _resample(df, startts, endts):
-    result = df.copy()
-    station = df.iloc[0].station
-    network = df.iloc[0].network
-    default_keys = {'station': station, 'network': network}
+# Every hour from startts to endts for every station in `df`, with the precip of
+# each hour summed and 0 for hours without reports. Station and network come back
+# categorical. The sums are one bincount over station x hour positions, so the
+# cost is a few passes over the output arrays.
+def _fill_hours(df, startts, endts):
+    stations = df.drop_duplicates('station').set_index('station').network.sort_index()
+    hours = pd.date_range(startts.floor('h'), endts.floor('h'), freq='h')
 
-    if startts not in df.valid.values:
-        result = result.append({'valid': startts, 'precip_in': 0, **default_keys}, ignore_index=True)
-    if endts not in df.valid.values:
-        result = result.append({'valid': endts, 'precip_in': 0, **default_keys}, ignore_index=True)
+    station = pd.Categorical(df.station, categories=stations.index).codes.astype(np.int64)
+    hour = ((df.valid.dt.floor('h') - hours[0]) // pd.Timedelta(1, 'h')).to_numpy()
+    inside = (hour >= 0) & (hour < len(hours))
+    precip = np.bincount(station[inside] * len(hours) + hour[inside], weights=df.precip_in.to_numpy()[inside],
+                         minlength=len(stations) * len(hours))
 
-    return result.resample('H', on='valid').agg({
-        'station': lambda arg: station,
-        'network': lambda arg: network,
-        'precip_in': sum,
-    }).reset_index()
+    codes = np.repeat(np.arange(len(stations), dtype=np.int32), len(hours))
+    networks = pd.Categorical(stations.to_numpy())
+    return pd.DataFrame({
+        'valid': np.tile(hours.to_numpy(), len(stations)),
+        'station': pd.Categorical.from_codes(codes, categories=stations.index),
+        'network': pd.Categorical.from_codes(networks.codes[codes], categories=networks.categories),
+        'precip_in': precip,
+    })
 
 
 def _retrieve_hourly_precip(stations, startts, endts, network):
-    url = HR_PRECIP_SERVICE + f'network={network}&tz=Etc/UTC&'
-    url += startts.strftime('year1=%Y&month1=%m&day1=%d&')
-    url += endts.strftime('year2=%Y&month2=%m&day2=%d&')
-    url += '&'.join([f'station={st}' for st in stations])
+    if USE_STORE:
+        df = _read_through('hourly_precip', _hourly_precip_url, 'valid', stations, startts, endts, network,
+                           parse_dates=['valid'])
+        return df[(df.valid >= startts) & (df.valid <= endts)]
 
+    url = _hourly_precip_url(stations, startts, endts, network)
     _print_if_debug(f'Getting data from url: {url}')
     return pd.read_csv(url, parse_dates=['valid'])
 
 
 def _retrieve_daily_summary(stations, startts, endts, network):
-    url = DAILY_SUMMARY_SERVICE + f'network={network}&'
-    url += startts.strftime('year1=%Y&month1=%m&day1=%d&')
-    url += endts.strftime('year2=%Y&month2=%m&day2=%d&')
-    url += '&'.join([f'station={st}' for st in stations])
+    if USE_STORE:
+        df = _read_through('daily_summary', _daily_summary_url, 'day', stations, startts, endts, network,
+                           parse_dates=['day'], na_values=['None'])
+        return df[(df.day >= startts.floor('D')) & (df.day <= endts)]
 
+    url = _daily_summary_url(stations, startts, endts, network)
     _print_if_debug(f'Getting data from url: {url}')
     return pd.read_csv(url, parse_dates=['day'], na_values=['None'])
 
 
+def _hourly_precip_url(stations, startts, endts, network):
+    url = HR_PRECIP_SERVICE + f'network={network}&tz=Etc/UTC&'
+    url += startts.strftime('year1=%Y&month1=%m&day1=%d&')
+    url += endts.strftime('year2=%Y&month2=%m&day2=%d&')
+    return url + '&'.join([f'station={st}' for st in stations])
+
+
+def _daily_summary_url(stations, startts, endts, network):
+    url = DAILY_SUMMARY_SERVICE + f'network={network}&'
+    url += startts.strftime('year1=%Y&month1=%m&day1=%d&')
+    url += endts.strftime('year2=%Y&month2=%m&day2=%d&')
+    return url + '&'.join([f'station={st}' for st in stations])
+
+
+# `stations` of `network` from startts to endts out of the local store (see
+# OBS_STORE_DIR), fetching whole station-years from `service` as needed. Each year
+# is requested through Jan 1 of the next, so rows on the boundary may be stored
+# twice; the later year's copy is kept.
+def _read_through(service, url_func, time_column, stations, startts, endts, network, **read_csv_kwargs):
+    directory = os.path.join(OBS_STORE_DIR, service)
+
+    tasks, refresh = {}, []
+    for st in stations:
+        for year in range(startts.year, endts.year + 1):
+            key = f'{network}/{st}/{year}'
+            tasks[key] = url_func([st], pd.Timestamp(year=year, month=1, day=1),
+                                  pd.Timestamp(year=year + 1, month=1, day=1), network)
+            if _incomplete(os.path.join(directory, f'{key}.parquet'), year):
+                refresh.append(key)
+
+    df = iem.download(tasks, directory, refresh=refresh, **read_csv_kwargs)
+    if df.empty:
+        return df
+    return df.drop_duplicates(subset=['station', time_column], keep='last').reset_index(drop=True)
+
+
+# whether the stored copy of `year` at `path` was written before the year was
+# complete and is due a refresh (false if there is none, as it is fetched anyway)
+def _incomplete(path, year):
+    if not os.path.exists(path):
+        return False
+    written = os.path.getmtime(path)
+    complete = (pd.Timestamp(year=year + 1, month=1, day=1) + COMPLETE_AFTER).timestamp()
+    return written < complete and time.time() - written > REFRESH_AFTER.total_seconds()
+
+
+# Catalog rows (stid, iem_network, ...) of the ASOS/AWOS `stations`; see
+# lib.stations for radius, nearest-station and box queries.
 def station_metadata(stations):
-    network_file = get_resource('asos_networks')
-    station_mapping = pd.read_csv(network_file)
-    network_query = (station_mapping.iem_network.str.contains('ASOS')) | (station_mapping.iem_network == 'AWOS')
-    query = (station_mapping.stid.isin(stations)) & network_query
-    return station_mapping[query]
+    return catalog().lookup(stations).reset_index()
 
 
 def _print_if_debug(thing):
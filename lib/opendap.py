@@ -0,0 +1,196 @@
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlsplit
+
+import numpy as np
+import pandas as pd
+import requests
+import xarray as xr
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Files are opened concurrently by up to MAX_WORKERS threads, sharing a pool of as
+# many kept-alive connections. Transient failures (dropped connections, 429/5xx
+# responses) are retried MAX_RETRIES times with exponential backoff starting at
+# RETRY_BACKOFF seconds, for metadata and data requests alike.
+MAX_WORKERS = 8
+MAX_RETRIES = 3
+RETRY_BACKOFF = 2.
+
+# Every opened dataset is recorded here (most recent last) as a Transfer of the
+# bytes its hyperslab was estimated to need against those actually received; with
+# DEBUG on, each response is also printed. See report().
+DEBUG = False
+TRANSFERS = deque(maxlen=1000)
+
+_SESSIONS = weakref.WeakKeyDictionary()
+_ANONYMOUS = requests.Session()
+
+
+# One pooled, authenticated HTTP session for OPeNDAP reads (e.g. RDA's THREDDS
+# server for ERA5), shared by every dataset it opens so later lazy data reads
+# reuse the same connections and retry policy.
+#
+# `hyperslab` arguments restrict what crosses the wire: {dim: index} of slices or
+# positions applied to every variable with that dimension, or a function of the
+# opened (still unread) dataset returning one. They are applied to the lazy
+# backend arrays before any dask chunking, so every data request's constraint
+# expression asks the server for just that hyperslab. Positions are read as
+# strided slices where they are evenly spaced and otherwise one slice per
+# contiguous run (e.g. the two sides of a box across the 0/360 seam), joined up
+# lazily.
+class OpendapSession(object):
+    def __init__(self, auth=None, session=None, max_workers=None, max_retries=None, backoff=None):
+        self.session = session or requests.Session()
+        if auth is not None:
+            self.session.auth = auth
+        self.max_workers = max_workers or MAX_WORKERS
+
+        retries = Retry(total=MAX_RETRIES if max_retries is None else max_retries,
+                        backoff_factor=RETRY_BACKOFF if backoff is None else backoff,
+                        status_forcelist=(429, 500, 502, 503, 504), allowed_methods=('GET', 'HEAD'))
+        adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers,
+                              max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    # The pooled session for a plain requests.Session (as era5 callers pass), made
+    # once per session so its connections stay alive between calls.
+    @classmethod
+    def of(cls, session):
+        if isinstance(session, cls):
+            return session
+        if session is None:
+            session = _ANONYMOUS
+        if session not in _SESSIONS:
+            _SESSIONS[session] = cls(session=session)
+        return _SESSIONS[session]
+
+    # Opens `url` lazily; with `chunks` (as for xr.open_dataset), or positions in
+    # the hyperslab that take more than one slice, the result is dask-backed.
+    # `preprocess` is applied to the subset dataset, as in xr.open_mfdataset.
+    def open(self, url, hyperslab=None, chunks=None, preprocess=None):
+        print('Opening dataset for ' + url)
+        transfer = Transfer(url)
+        store = xr.backends.PydapDataStore.open(url, application=self.application(url, transfer))
+        ds = xr.open_dataset(store)
+        if hyperslab is not None:
+            ds = _read_hyperslab(ds, hyperslab(ds) if callable(hyperslab) else hyperslab, chunks)
+        elif chunks is not None:
+            ds = ds.chunk(chunks)
+        if preprocess is not None:
+            ds = preprocess(ds)
+
+        transfer.estimated = ds.nbytes
+        TRANSFERS.append(transfer)
+        return ds
+
+    # Opens `urls` concurrently and combines them by their coordinates (as
+    # xr.open_mfdataset does), dask-backed.
+    def open_many(self, urls, hyperslab=None, chunks=None, preprocess=None):
+        chunks = {} if chunks is None else chunks
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            datasets = list(pool.map(lambda url: self.open(url, hyperslab, chunks, preprocess), urls))
+        return xr.combine_by_coords(datasets, combine_attrs='override')
+
+    # pydap versions differ in whether (and how) they use a passed session, so
+    # requests are routed through this session as a WSGI application instead.
+    def application(self, url, transfer=None):
+        return _SessionApplication(self.session, url, transfer)
+
+
+# Bytes of one opened dataset: `estimated` is the size of its (subset) variables,
+# `received` what has come over the wire so far, metadata included. Data is read
+# lazily, so `received` grows as the dataset is loaded.
+class Transfer(object):
+    def __init__(self, url, estimated=0):
+        self.url = url
+        self.estimated = estimated
+        self.received = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def add(self, nbytes):
+        with self._lock:
+            self.received += nbytes
+            self.requests += 1
+
+    def __repr__(self):
+        return (f'transfer({self.url}, estimated={self.estimated / 1e6:.2f} MB, '
+                f'received={self.received / 1e6:.2f} MB in {self.requests} requests)')
+
+
+# Estimated and received MB of `transfers` (by default the last `last` of
+# TRANSFERS, or all of them) as a DataFrame by URL.
+def report(transfers=None, last=None):
+    if transfers is None:
+        transfers = list(TRANSFERS)[-last:] if last else list(TRANSFERS)
+    return pd.DataFrame({
+        'url': [t.url for t in transfers],
+        'requests': [t.requests for t in transfers],
+        'estimated_mb': [t.estimated / 1e6 for t in transfers],
+        'received_mb': [t.received / 1e6 for t in transfers],
+    }).set_index('url')
+
+
+# ds.isel(indexers) as few slices as possible, combined lazily when it takes more
+# than one.
+def _read_hyperslab(ds, indexers, chunks=None):
+    indexers = {dim: _as_slice(index) for dim, index in indexers.items()}
+    for dim, index in indexers.items():
+        if isinstance(index, np.ndarray):
+            runs = np.split(index, np.flatnonzero(np.diff(index) != 1) + 1)
+            pieces = [_read_hyperslab(ds, {**indexers, dim: slice(run[0], run[-1] + 1)}, chunks or {})
+                      for run in runs]
+            return xr.concat(pieces, dim=dim, data_vars='minimal', coords='minimal', compat='override',
+                             join='override')
+    ds = ds.isel(indexers)
+    return ds if chunks is None else ds.chunk(chunks)
+
+
+# `index` as a slice if it is one (an int or evenly spaced ascending positions),
+# else as an array of positions.
+def _as_slice(index):
+    if isinstance(index, (slice, int, np.integer)):
+        return index
+    index = np.asarray(index, dtype=int)
+    if len(index) == 0:
+        return slice(0, 0)
+    step = index[1] - index[0] if len(index) > 1 else 1
+    if step > 0 and np.all(np.diff(index) == step):
+        return slice(index[0], index[-1] + 1, step)
+    return index
+
+
+# WSGI application pydap sends its requests to, fetching them from the server of
+# `url` with `session` and counting the bytes into `transfer`.
+class _SessionApplication(object):
+    DROP_HEADERS = ('connection', 'keep-alive', 'transfer-encoding', 'content-encoding', 'content-length')
+
+    def __init__(self, session, url, transfer=None):
+        scheme, netloc, *_ = urlsplit(url)
+        self.base = f'{scheme}://{netloc}'
+        self.session = session
+        self.transfer = transfer
+
+    def __call__(self, environ, start_response):
+        url = self.base + quote(environ['PATH_INFO'])
+        if environ.get('QUERY_STRING'):
+            url += '?' + environ['QUERY_STRING']
+        response = self.session.get(url)
+        # bytes over the wire, before any content decoding
+        received = response.raw.tell() if hasattr(response.raw, 'tell') else len(response.content)
+        if self.transfer is not None:
+            self.transfer.add(received)
+        if DEBUG:
+            print(f'{url}: {response.status_code}, {received / 1e6:.2f} MB')
+        # pydap would try to parse an error page as DAP, so e.g. a file that isn't
+        # on the server (404) surfaces as a requests.HTTPError instead
+        response.raise_for_status()
+
+        headers = [(k, v) for k, v in response.headers.items() if k.lower() not in self.DROP_HEADERS]
+        headers.append(('Content-Length', str(len(response.content))))
+        start_response(f'{response.status_code} {response.reason}', headers)
+        return [response.content]
@@ -0,0 +1,202 @@
+import os
+from collections import deque
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Local Zarr archive of reanalysis variables, one chunked, compressed store per
+# variable at ARCHIVE_DIR/<source>/<name>.zarr, where name mirrors the remote path
+# (e.g. ncep_r1/ncep.reanalysis.dailyavgs/pressure/hgt.zarr). Stores are filled and
+# extended with lib.reanalysis.build_archive; lib.ncep_r1, lib.era5 and
+# lib.reanalysis.r1 read from them whenever they cover a request.
+ARCHIVE_DIR = os.getenv('WEATHER_ARCHIVE_DIR', os.path.join(os.path.expanduser('~'), 'weather-archive'))
+
+# Chunk shape of new stores, by source and dimension (dimensions not listed are
+# kept whole). Chunks are ~2.5 MB uncompressed tiles of the grid over a stretch of
+# time, so a point time series reads one chunk per year (NCEP) or day (ERA5)
+# and a map one chunk per tile.
+CHUNKS = {
+    'ncep_r1': {'time': 365, 'level': 1, 'lat': 37, 'lon': 48},
+    'era5': {'time': 24, 'level': 1, 'latitude': 121, 'longitude': 240},
+}
+
+# Extra chunkings a variable can also be stored in, next to the default store as
+# <name>.<layout>.zarr: 'series' holds long time series of small tiles (a point
+# time series is a handful of chunks), 'maps' whole maps for a few times. Routed
+# reads (see read) go to whichever layout touches the fewest bytes.
+LAYOUTS = {
+    'ncep_r1': {
+        'series': {'time': 4096, 'level': 1, 'lat': 4, 'lon': 4},
+        'maps': {'time': 30, 'level': 1},
+    },
+    'era5': {
+        'series': {'time': 744, 'level': 1, 'latitude': 16, 'longitude': 16},
+        'maps': {'time': 1, 'level': 1},
+    },
+}
+
+# Routed reads are recorded here (most recent last) as dicts of the layout chosen
+# and the chunks and bytes each layout would have touched; with DEBUG on they are
+# also printed.
+DEBUG = False
+READS = deque(maxlen=1000)
+
+
+def path(source, name, directory=None, layout=None):
+    store = f'{name}.{layout}.zarr' if layout else f'{name}.zarr'
+    return os.path.join(directory or ARCHIVE_DIR, source, store)
+
+
+def exists(source, name, directory=None, layout=None):
+    return os.path.exists(path(source, name, directory, layout))
+
+
+# The archived variable as a lazy, dask-backed dataset.
+def open_variable(source, name, directory=None, layout=None):
+    return xr.open_zarr(path(source, name, directory, layout), consolidated=True)
+
+
+# The archived variable between `start` and `end` (inclusive), or None if it isn't
+# archived or the archive doesn't cover that whole range.
+#
+# With `route`, a function returning the positional indexers (as for isel) that
+# the caller will apply to the returned dataset, the data comes from whichever
+# stored layout of the variable touches the fewest bytes for them.
+def read(source, name, start=None, end=None, directory=None, route=None):
+    if not exists(source, name, directory):
+        return None
+
+    ds = open_variable(source, name, directory)
+    times = ds.indexes['time']
+    if start is not None and (len(times) == 0 or times[0] > pd.Timestamp(start)):
+        return None
+    if end is not None and (len(times) == 0 or times[-1] < pd.Timestamp(end)):
+        return None
+
+    lo = 0 if start is None else times.searchsorted(pd.Timestamp(start), side='left')
+    hi = len(times) if end is None else times.searchsorted(pd.Timestamp(end), side='right')
+    ranged = ds.isel(time=slice(lo, hi))
+    if route is None:
+        return ranged
+
+    indexers = dict(route(ranged))
+    time_positions = np.arange(hi - lo) if indexers.get('time') is None else np.arange(hi - lo)[indexers['time']]
+    indexers['time'] = lo + np.atleast_1d(time_positions)
+
+    layout = _route(source, name, directory, ds, indexers)
+    if layout is None:
+        return ranged
+    return open_variable(source, name, directory, layout).isel(time=slice(lo, hi))
+
+
+# Layouts of the variable stored alongside the default one, in step with it.
+def layouts(source, name, directory=None):
+    found = []
+    default_times = open_variable(source, name, directory).indexes['time']
+    for layout in LAYOUTS.get(source, {}):
+        if exists(source, name, directory, layout):
+            times = open_variable(source, name, directory, layout).indexes['time']
+            if times.equals(default_times):
+                found.append(layout)
+    return found
+
+
+# Number of stored chunks and (uncompressed) bytes that reading `indexers` from
+# `ds` touches.
+def read_cost(ds, indexers):
+    nchunks = nbytes = 0
+    for var in ds.data_vars.values():
+        chunks = var.encoding['chunks']
+        touched = [_chunks_touched(indexers.get(dim), ds.sizes[dim], size) for dim, size in zip(var.dims, chunks)]
+        itemsize = np.dtype(var.encoding.get('dtype', var.dtype)).itemsize
+        count = int(np.prod(touched))
+        nchunks += count
+        nbytes += count * int(np.prod(chunks)) * itemsize
+    return nchunks, nbytes
+
+
+# Writes `ds` to the archive: creates the store on first write, and afterwards
+# appends only the times later than the last archived one, so re-running an ingest
+# over overlapping periods is safe. Returns the number of times written.
+#
+# `layout` writes one of the extra chunkings in LAYOUTS instead of the default store.
+def write(ds, source, name, chunks=None, directory=None, layout=None):
+    store = path(source, name, directory, layout)
+    ds = _without_chunk_encoding(ds)
+
+    if not os.path.exists(store):
+        default_chunks = LAYOUTS[source][layout] if layout else CHUNKS.get(source, {})
+        chunks = {**default_chunks, **(chunks or {})}
+        chunks = {dim: size for dim, size in chunks.items() if dim in ds.dims}
+        encoding = {var: {'chunks': tuple(chunks.get(dim, ds.sizes[dim]) for dim in ds[var].dims),
+                          'compressor': _compressor()}
+                    for var in ds.data_vars}
+        os.makedirs(os.path.dirname(store), exist_ok=True)
+        ds.chunk(chunks).to_zarr(store, mode='w-', encoding=encoding, consolidated=True)
+        return ds.sizes['time']
+
+    existing = open_variable(source, name, directory, layout)
+    ds = ds.isel(time=np.flatnonzero(ds.indexes['time'] > existing.indexes['time'][-1]))
+    if ds.sizes['time'] == 0:
+        return 0
+
+    # each stored chunk must be written by exactly one dask chunk, so the first one
+    # only tops up the partly filled last chunk; xarray's own check doesn't allow
+    # for that offset, hence safe_chunks=False
+    chunks = _stored_chunks(existing)
+    chunks['time'] = _append_chunks(existing.sizes['time'], ds.sizes['time'], chunks['time'])
+    ds.chunk({dim: size for dim, size in chunks.items() if dim in ds.dims}).to_zarr(
+        store, append_dim='time', consolidated=True, safe_chunks=False)
+    return ds.sizes['time']
+
+
+def _route(source, name, directory, default, indexers):
+    costs = {None: read_cost(default, indexers)}
+    for layout in layouts(source, name, directory):
+        costs[layout] = read_cost(open_variable(source, name, directory, layout), indexers)
+    best = min(costs, key=lambda layout: costs[layout][1])
+
+    READS.append({'source': source, 'name': name, 'layout': best or 'default',
+                  'costs': {layout or 'default': cost for layout, cost in costs.items()}})
+    if DEBUG:
+        summary = ', '.join(f'{layout or "default"} {nchunks} chunks/{nbytes / 1e6:.1f} MB'
+                            for layout, (nchunks, nbytes) in costs.items())
+        print(f'{source}/{name}: reading {best or "default"} layout ({summary})')
+    return best
+
+
+def _chunks_touched(indexer, size, chunk):
+    if indexer is None:
+        return -(-size // chunk)
+    positions = np.arange(size)[indexer] if isinstance(indexer, slice) else np.atleast_1d(indexer)
+    return len(np.unique(positions // chunk))
+
+
+def _compressor():
+    from numcodecs import Blosc
+    return Blosc(cname='zstd', clevel=5, shuffle=Blosc.BITSHUFFLE)
+
+
+# chunk length of each dimension in an existing store
+def _stored_chunks(ds):
+    chunks = {}
+    for var in ds.data_vars.values():
+        chunks.update(zip(var.dims, var.encoding['chunks']))
+    return chunks
+
+
+def _append_chunks(stored, new, chunk):
+    first = min(-stored % chunk or chunk, new)
+    rest = new - first
+    return (first,) + (chunk,) * (rest // chunk) + ((rest % chunk,) if rest % chunk else ())
+
+
+# NetCDF chunking carried over in the encoding would override the archive's
+def _without_chunk_encoding(ds):
+    ds = ds.copy()
+    for var in ds.variables.values():
+        var.encoding.pop('chunks', None)
+        var.encoding.pop('preferred_chunks', None)
+        var.encoding.pop('chunksizes', None)
+    return ds
@@ -0,0 +1,167 @@
+import argparse
+import os
+import time
+
+import pandas as pd
+import requests
+import xarray as xr
+
+from lib import era5, ncep_r1
+from lib.reanalysis import archive
+
+# Builds and extends the local Zarr archive (see lib.reanalysis.archive). Run from
+# the repository root, e.g.
+#
+#   python -m lib.reanalysis.build_archive ncep-r1 pressure/hgt --years 1948 2023
+#   python -m lib.reanalysis.build_archive ncep-r1 pressure/hgt --folder ncep.reanalysis --update
+#   python -m lib.reanalysis.build_archive era5 HEIGHT --start 2021-01-01 --end 2021-03-31
+#   python -m lib.reanalysis.build_archive files $WORKDIR/hgt.mon.mean.nc \
+#       --source ncep_r1 --name ncep.reanalysis.derived/pressure/hgt.mon.mean
+#
+# --layout (repeatable) picks the chunkings to write: 'default' and/or the extra
+# ones in archive.LAYOUTS. Reads need the default store and are routed to
+# whichever layout in step with it touches the fewest bytes.
+#
+# Every ingest appends only the times newer than what's archived, so --update (or
+# re-running over an overlapping period) picks up new months.
+
+
+def ingest_ncep_r1(product, years, folder='ncep.reanalysis.dailyavgs', directory=None, layouts=(None,)):
+    name = f'{folder}/{product}'
+    for year in years:
+        ds = ncep_r1.open_year(year, folder, product, chunks={'time': ncep_r1.LAZY_TIME_CHUNK})
+        _write(ds, 'ncep_r1', name, year, directory, layouts)
+
+
+# Appends everything after the last archived time, through the current year.
+def update_ncep_r1(product, folder='ncep.reanalysis.dailyavgs', directory=None, layouts=(None,)):
+    last = _last_time('ncep_r1', f'{folder}/{product}', directory, layouts)
+    ingest_ncep_r1(product, range(last.year, pd.Timestamp.now().year + 1), folder, directory, layouts)
+
+
+# Monthly means are ingested a year file at a time and hourly analyses a month of
+# daily files at a time. With `until_unpublished`, a period whose files RDA doesn't
+# have yet (404) ends the ingest instead of raising.
+def ingest_era5(var_name, start, end, session, monthly=False, directory=None, layouts=(None,),
+                until_unpublished=False):
+    var = getattr(era5.PL_VARS, var_name)
+    product = era5.PL_MONTHLY if monthly else era5.PL_DAILY
+    name = era5.archive_name(product, var)
+
+    if monthly:
+        periods = [[year] for year in range(pd.Timestamp(start).year, pd.Timestamp(end).year + 1)]
+    else:
+        days = pd.date_range(pd.Timestamp(start).floor('D'), pd.Timestamp(end).floor('D'), freq='D')
+        periods = [list(month_days) for _, month_days in days.groupby(days.to_period('M')).items()]
+
+    for period in periods:
+        label = period[0] if monthly else f'{period[0]:%Y-%m}'
+        try:
+            if monthly:
+                ds = era5.open_dataset(era5.pl_monthly_url(period[0], var), session, chunks={})
+            else:
+                ds = era5.open_pl_daily(period, var, session)
+        except requests.HTTPError as e:
+            if not (until_unpublished and e.response is not None and e.response.status_code == 404):
+                raise
+            print(f'{name} {label}: not published on RDA yet, stopping')
+            return
+        _write(ds, 'era5', name, label, directory, layouts)
+
+
+# Appends everything after the last archived time that RDA has published. ERA5
+# reaches RDA months late, so the update stops at the first period with a file
+# that isn't there yet (404), having written the ones before it. Year files of
+# monthly means only exist once the year is over, so those go through last year.
+def update_era5(var_name, session, monthly=False, directory=None, layouts=(None,)):
+    var = getattr(era5.PL_VARS, var_name)
+    product = era5.PL_MONTHLY if monthly else era5.PL_DAILY
+    last = _last_time('era5', era5.archive_name(product, var), directory, layouts)
+    end = pd.Timestamp(year=pd.Timestamp.now().year - 1, month=12, day=1) if monthly else pd.Timestamp.now()
+    if end < last.floor('D'):
+        print(f'{era5.archive_name(product, var)}: up to date')
+        return
+    ingest_era5(var_name, last.floor('D'), end, session, monthly, directory, layouts, until_unpublished=True)
+
+
+# Local NetCDF files (e.g. the monolithic monthly files in $WORKDIR), in time order.
+def ingest_files(paths, source, name, directory=None, layouts=(None,)):
+    with ncep_r1.NETCDF_LOCK:
+        ds = xr.open_mfdataset(sorted(paths), chunks={}, combine='by_coords')
+    _write(ds, source, name, 'files', directory, layouts)
+
+
+def _write(ds, source, name, period, directory, layouts):
+    for layout in layouts:
+        start = time.perf_counter()
+        written = archive.write(ds, source, name, directory=directory, layout=layout)
+        print(f'{name} ({layout or "default"}) {period}: appended {written} times '
+              f'in {time.perf_counter() - start:.1f} s')
+
+
+# the earliest of the layouts' last times, so an update brings all of them up to date
+def _last_time(source, name, directory=None, layouts=(None,)):
+    last = []
+    for layout in layouts:
+        if not archive.exists(source, name, directory, layout):
+            raise FileNotFoundError(f'{archive.path(source, name, directory, layout)} does not exist yet, '
+                                    f'ingest a period first')
+        last.append(pd.Timestamp(archive.open_variable(source, name, directory, layout).indexes['time'][-1]))
+    return min(last)
+
+
+# RDA credentials come from RDA_USER / RDA_PASSWORD
+def _rda_session():
+    session = requests.Session()
+    session.auth = (os.environ['RDA_USER'], os.environ['RDA_PASSWORD'])
+    return session
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Build or extend the local Zarr reanalysis archive')
+    parser.add_argument('--directory', default=None, help=f'archive root (default {archive.ARCHIVE_DIR})')
+    parser.add_argument('--layout', action='append', dest='layouts',
+                        choices=['default', 'series', 'maps'], help='chunkings to write (default: default)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    ncep = commands.add_parser('ncep-r1', help='NCEP R1 year files over OPeNDAP')
+    ncep.add_argument('product', help="e.g. 'pressure/hgt'")
+    ncep.add_argument('--folder', default='ncep.reanalysis.dailyavgs')
+    ncep.add_argument('--years', nargs=2, type=int, metavar=('FIRST', 'LAST'))
+    ncep.add_argument('--update', action='store_true', help='append everything since the last archived time')
+
+    e5 = commands.add_parser('era5', help='ERA5 pressure level analyses from RDA')
+    e5.add_argument('var', choices=[name for name in vars(era5.PL_VARS) if not name.startswith('_')])
+    e5.add_argument('--monthly', action='store_true', help='monthly means instead of hourly analyses')
+    e5.add_argument('--start')
+    e5.add_argument('--end')
+    e5.add_argument('--update', action='store_true', help='append everything since the last archived time')
+
+    files = commands.add_parser('files', help='local NetCDF files')
+    files.add_argument('paths', nargs='+')
+    files.add_argument('--source', required=True)
+    files.add_argument('--name', required=True)
+
+    args = parser.parse_args(args)
+    layouts = [None if layout == 'default' else layout for layout in args.layouts or ['default']]
+    if args.command == 'ncep-r1':
+        if args.update:
+            update_ncep_r1(args.product, args.folder, args.directory, layouts)
+        elif args.years:
+            ingest_ncep_r1(args.product, range(args.years[0], args.years[1] + 1), args.folder, args.directory,
+                           layouts)
+        else:
+            parser.error('ncep-r1 needs --years or --update')
+    elif args.command == 'era5':
+        if args.update:
+            update_era5(args.var, _rda_session(), args.monthly, args.directory, layouts)
+        elif args.start and args.end:
+            ingest_era5(args.var, args.start, args.end, _rda_session(), args.monthly, args.directory, layouts)
+        else:
+            parser.error('era5 needs --start and --end, or --update')
+    else:
+        ingest_files(args.paths, args.source, args.name, args.directory, layouts)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,19 @@
 import os
 import warnings
+from functools import partial
 
 import numpy as np
 import pandas as pd
 import xarray as xr
 from xarray import SerializationWarning
 
+from lib.climatology import composite, ltm_at, ltm_positions
+from lib.longitude import arc_positions, select_lon
+from lib.reanalysis import archive
+
+# months of data hgt_composites holds in memory at once
+BATCH_MONTHS = 120
+
 
 def hgt_monthly(level, yearmonths, bbox=None):
     yearmonths = list(map(pd.Timestamp, yearmonths))
@@ -13,41 +21,77 @@ def hgt_monthly(level, yearmonths, bbox=None):
     with warnings.catch_warnings():
         warnings.filterwarnings('ignore', category=SerializationWarning)
 
-        workdir = os.getenv('WORKDIR')
+        ds_mon = _open_monthly('hgt.mon.mean', partial(_positions, level=level, times=yearmonths, bbox=bbox))
+        ds_mon_mean = _open_monthly('hgt.mon.ltm', partial(_positions, level=level, ltm_times=yearmonths, bbox=bbox))
+
+        return _hgt_at(ds_mon, ds_mon_mean, level, yearmonths, bbox)
+
+
+# Composites of monthly height anomalies at `level` (see
+# lib.climatology.composite): `groups` is a dict of name -> dates (or one list of
+# dates), each standing for its month, e.g. {'cold_wet': [...], 'warm_wet': [...]}.
+# Only the months in some group are read, `batch` months at a time.
+def hgt_composites(level, groups, bbox=None, batch=BATCH_MONTHS):
+    def months(dates):
+        return pd.DatetimeIndex(dates).to_period('M').to_timestamp()
+
+    groups = {name: months(dates) for name, dates in groups.items()} if isinstance(groups, dict) else months(groups)
+    listed = groups.values() if isinstance(groups, dict) else [groups]
+    all_months = pd.DatetimeIndex(np.unique(np.concatenate([dates.values for dates in listed])))
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', category=SerializationWarning)
+        ds_mon = _open_monthly('hgt.mon.mean', partial(_positions, level=level, times=all_months, bbox=bbox))
+        ds_mon_mean = _open_monthly('hgt.mon.ltm',
+                                    partial(_positions, level=level, ltm_times=all_months, bbox=bbox))
+
+    def read(yearmonths):
+        return _hgt_at(ds_mon, ds_mon_mean, level, yearmonths, bbox)[2].hgt
+
+    return composite(read, groups, batch=batch)
 
-        ds_mon = xr.open_dataset(os.path.join(workdir, 'hgt.mon.mean.nc'))
-        ds_mon_mean = xr.open_dataset(os.path.join(workdir, 'hgt.mon.ltm.nc'))
 
-        years = set(dt.year for dt in yearmonths)
-        ds_mon_mean = _coerce_ltm_ds(ds_mon_mean, years)
+# Heights, their LTM and anomalies at `level` for `yearmonths` out of the opened
+# monthly files.
+def _hgt_at(ds_mon, ds_mon_mean, level, yearmonths, bbox=None):
+    kw = {
+        'level': level,
+    }
 
-        kw = {
-            'level': level,
-            'time': yearmonths,
-        }
+    if bbox is not None:
+        west, east, north, south = bbox
+        kw['lat'] = slice(north, south)
 
-        if bbox is not None:
-            west, east, north, south = bbox
-            kw['lon'] = slice(west, east)
-            kw['lat'] = slice(north, south)
+    hgt_ret = ds_mon.sel(time=yearmonths, **kw)
+    hgt_mean_ret = ds_mon_mean.sel(**kw)
+    if bbox is not None:
+        # west to east may cross the 0/360 seam, e.g. (170, 205) or (-20, 40)
+        hgt_ret = select_lon(hgt_ret, west, east)
+        hgt_mean_ret = select_lon(hgt_mean_ret, west, east)
+    hgt_mean_ret = ltm_at(hgt_mean_ret, hgt_ret.time.values)
+    hgt_anom_ret = hgt_ret - hgt_mean_ret
+    return hgt_ret, hgt_mean_ret, hgt_anom_ret
 
-        hgt_ret = ds_mon.sel(**kw)
-        hgt_mean_ret = ds_mon_mean.sel(**kw)
-        hgt_anom_ret = hgt_ret - hgt_mean_ret
-        return hgt_ret, hgt_mean_ret, hgt_anom_ret
 
+# NCEP R1 monthly file `name` (e.g. 'hgt.mon.mean') from the local archive if it has
+# been ingested there (in the layout best suited to the `route` positions), otherwise
+# from the NetCDF file in $WORKDIR.
+def _open_monthly(name, route=None):
+    archived = archive.read('ncep_r1', f'ncep.reanalysis.derived/pressure/{name}', route=route)
+    if archived is not None:
+        return archived
+    return xr.open_dataset(os.path.join(os.getenv('WORKDIR'), f'{name}.nc'))
 
-def _coerce_ltm_ds(ds, years):
-    orig_times = ds.time.values
-    concat_datasets = []
-    for year in years:
-        ds_for_year = ds.copy()
-        newtimes = np.array([pd.Timestamp(year=year,
-                                          month=t.month,
-                                          day=t.day,
-                                          hour=t.hour,
-                                          minute=t.minute) for t in orig_times])
-        ds_for_year['time'] = newtimes
-        concat_datasets.append(ds_for_year)
 
-    return xr.concat(concat_datasets, dim='time')
+# positions hgt_monthly reads, to route archive reads
+def _positions(ds, level, times=None, ltm_times=None, bbox=None):
+    indexers = {'level': ds.indexes['level'].get_loc(level)}
+    if times is not None:
+        indexers['time'] = ds.indexes['time'].get_indexer(times)
+    if ltm_times is not None:
+        indexers['time'] = ltm_positions(ltm_times, ds['time'].values)
+    if bbox is not None:
+        west, east, north, south = bbox
+        indexers['lat'] = ds.indexes['lat'].slice_indexer(north, south)
+        indexers['lon'] = arc_positions(ds['lon'].values, west, east)[0]
+    return indexers
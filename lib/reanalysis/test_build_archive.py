@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+import xarray as xr
+
+from lib import era5, opendap
+from lib.reanalysis import archive, build_archive
+from lib.test_opendap import LATITUDES, LEVELS, LONGITUDES, SERVER, StandInServer, day_file, served
+
+YEAR = pd.Timestamp.now().year
+
+
+# A year file of monthly mean U, as the xarray dataset and as pydap serves it
+def monthly_file(year):
+    times = pd.date_range(f'{year}-01-01', periods=12, freq='MS')
+    values = np.random.default_rng(year).normal(size=(12, len(LEVELS), len(LATITUDES), len(LONGITUDES)))
+    ds = xr.Dataset({'U': (('time', 'level', 'latitude', 'longitude'), values.astype(np.float32))},
+                    coords={'time': times, 'level': LEVELS, 'latitude': LATITUDES, 'longitude': LONGITUDES})
+    return ds, served(ds)
+
+
+# RDA with only the files in `urls` published, and an empty archive
+@pytest.fixture
+def rda(monkeypatch, tmp_path):
+    monkeypatch.setattr(archive, 'ARCHIVE_DIR', str(tmp_path))
+    opendap.TRANSFERS.clear()
+
+    def publish(files):
+        datasets = {url[len(era5.RDA_THREDDS_URL):]: dataset for url, dataset in files.items()}
+        monkeypatch.setattr(era5, 'RDA_THREDDS_URL', SERVER)
+        stand_in = StandInServer(datasets)
+        session = requests.Session()
+        session.mount(SERVER, stand_in)
+        return stand_in, session
+    return publish
+
+
+def archived_times(product):
+    name = era5.archive_name(product, era5.PL_VARS.U_WIND)
+    return archive.open_variable('era5', name).indexes['time']
+
+
+def test_update_stops_at_unpublished_days(rda):
+    days = pd.date_range('2021-02-26', '2021-02-28', freq='D')
+    stand_in, session = rda({era5.pl_daily_url(day, era5.PL_VARS.U_WIND): day_file(day)[1] for day in days})
+    build_archive.ingest_era5('U_WIND', days[0], days[0], session)
+
+    build_archive.update_era5('U_WIND', session)
+
+    times = archived_times(era5.PL_DAILY)
+    assert times[0] == days[0] and times[-1] == pd.Timestamp('2021-02-28 23:00') and len(times) == 72
+    # March is the first month that isn't there, and the update goes no further
+    opened = {url.split('/e5.oper.an.pl/')[1][:6] for url, _ in stand_in.requests}
+    assert opened == {'202102', '202103'}
+
+
+def test_unpublished_day_raises_outside_update(rda):
+    stand_in, session = rda({era5.pl_daily_url('2021-02-01', era5.PL_VARS.U_WIND): day_file('2021-02-01')[1]})
+    with pytest.raises(requests.HTTPError):
+        build_archive.ingest_era5('U_WIND', '2021-02-01', '2021-02-02', session)
+
+
+def test_monthly_update_ends_last_year(rda):
+    stand_in, session = rda({era5.pl_monthly_url(year, era5.PL_VARS.U_WIND): monthly_file(year)[1]
+                             for year in (YEAR - 2, YEAR - 1)})
+    build_archive.ingest_era5('U_WIND', f'{YEAR - 2}-01-01', f'{YEAR - 2}-12-01', session, monthly=True)
+
+    build_archive.update_era5('U_WIND', session, monthly=True)
+
+    times = archived_times(era5.PL_MONTHLY)
+    assert times[-1] == pd.Timestamp(year=YEAR - 1, month=12, day=1) and len(times) == 24
+    assert not any(f'.{YEAR}010100_' in url for url, _ in stand_in.requests)
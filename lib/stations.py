@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+from config import get_resource
+
+from lib.longitude import arc_positions
+
+EARTH_RADIUS_KM = 6371.
+
+_CATALOG = None
+
+
+# The ASOS/AWOS station catalog (the asos_networks resource), parsed once per
+# process.
+def catalog():
+    global _CATALOG
+    if _CATALOG is None:
+        _CATALOG = StationCatalog.read_csv(get_resource('asos_networks'))
+    return _CATALOG
+
+
+# ASOS and AWOS stations indexed by id, with a stid -> network dict for lookups,
+# stations sorted by latitude for box queries, and a haversine BallTree over
+# lat/lon (built on first use) for distance queries. Query results are rows of
+# `stations`, a DataFrame indexed by stid with iem_network, lat and lon columns (and
+# whatever else the resource has).
+class StationCatalog(object):
+    NETWORK_PATTERN = 'ASOS'
+    OTHER_NETWORKS = ('AWOS',)
+
+    def __init__(self, df):
+        query = df.iem_network.str.contains(self.NETWORK_PATTERN) | df.iem_network.isin(self.OTHER_NETWORKS)
+        stations = df[query].drop_duplicates('stid').set_index('stid')
+        stations['iem_network'] = stations.iem_network.astype('category')
+        self.stations = stations
+        self.networks = dict(zip(stations.index, stations.iem_network.astype(str)))
+
+        self._by_lat = None
+        self._tree = None
+
+    @classmethod
+    def read_csv(cls, path):
+        return cls(pd.read_csv(path))
+
+    def __len__(self):
+        return len(self.stations)
+
+    def __contains__(self, stid):
+        return stid in self.networks
+
+    # Rows of the stations in `stids` (a station or list of stations) that are in
+    # the catalog, in the order given.
+    def lookup(self, stids):
+        stids = [stids] if isinstance(stids, str) else list(stids)
+        return self.stations.loc[[stid for stid in stids if stid in self.networks]]
+
+    # Stations within `radius_km` of (lat, lon), nearest first, with a distance_km
+    # column. With arrays of points, a list of such frames, one per point.
+    def within(self, lat, lon, radius_km):
+        points = self._points(lat, lon)
+        positions, distances = self.tree.query_radius(points, r=radius_km / EARTH_RADIUS_KM,
+                                                       return_distance=True, sort_results=True)
+        found = [self._rows(p, d) for p, d in zip(positions, distances)]
+        return found[0] if np.ndim(lat) == 0 else found
+
+    # The `k` stations nearest to (lat, lon), as for within.
+    def nearest(self, lat, lon, k=1):
+        distances, positions = self.tree.query(self._points(lat, lon), k=min(k, len(self)))
+        found = [self._rows(p, d) for p, d in zip(positions, distances)]
+        return found[0] if np.ndim(lat) == 0 else found
+
+    # Stations inside `bbox`, a Geobbox or a (west, east, south, north) tuple as
+    # Geobbox takes; boxes may cross the dateline.
+    def in_bbox(self, bbox):
+        if hasattr(bbox, 'bounds_transform'):
+            import cartopy.crs as ccrs
+            bbox = bbox.bounds_transform(ccrs.PlateCarree())
+        west, east, south, north = bbox[0], bbox[1], bbox[2], bbox[3]
+
+        lats, order = self._lat_order
+        candidates = order[lats.searchsorted(south, side='left'):lats.searchsorted(north, side='right')]
+        inside = arc_positions(self.stations.lon.to_numpy()[candidates], west, east)[0]
+        return self.stations.iloc[np.sort(candidates[inside])]
+
+    @property
+    def _lat_order(self):
+        if self._by_lat is None:
+            order = np.argsort(self.stations.lat.to_numpy(), kind='stable')
+            self._by_lat = self.stations.lat.to_numpy()[order], order
+        return self._by_lat
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            from sklearn.neighbors import BallTree
+            self._tree = BallTree(np.radians(self.stations[['lat', 'lon']].to_numpy()), metric='haversine')
+        return self._tree
+
+    def _points(self, lat, lon):
+        lat, lon = np.broadcast_arrays(np.atleast_1d(lat), np.atleast_1d(lon))
+        return np.radians(np.column_stack([lat, lon]).astype(np.float64))
+
+    def _rows(self, positions, distances):
+        rows = self.stations.iloc[positions].copy()
+        rows['distance_km'] = distances * EARTH_RADIUS_KM
+        return rows
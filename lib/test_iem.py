@@ -0,0 +1,163 @@
+import io
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+import urllib3
+
+from lib import iem
+
+SERVER = 'https://mesonet.test/cgi-bin/request/asos.py'
+STATIONS = ('KORD', 'KMDW')
+YEARS = (2019, 2020, 2021)
+
+
+def url(station, year):
+    return f'{SERVER}?station={station}&year1={year}'
+
+
+def csv(station, year):
+    times = pd.date_range(f'{year}-01-01', periods=5, freq='h')
+    rows = [f'{station},{t:%Y-%m-%d %H:%M},{year % 100 + i}.5' for i, t in enumerate(times)]
+    return ('station,valid,tmpf\n' + '\n'.join(rows) + '\n').encode()
+
+
+# Answers requests to SERVER with the CSV of the station and year in the query,
+# after first giving, per URL, the scripted failures in `failures`: a status code,
+# a (status code, Retry-After) pair, or 'truncated' for a body cut off halfway
+# through its Content-Length. Records each URL and when it was asked for.
+class StandInIEM(requests.adapters.BaseAdapter):
+    def __init__(self, failures=None):
+        super().__init__()
+        self.failures = {key: list(value) for key, value in (failures or {}).items()}
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append((request.url, time.monotonic()))
+        query = parse_qs(urlsplit(request.url).query)
+        body = csv(query['station'][0], int(query['year1'][0]))
+        failures = self.failures.get(request.url)
+        failure = failures.pop(0) if failures else None
+
+        status, headers, sent = 200, {'Content-Length': str(len(body))}, body
+        if failure == 'truncated':
+            sent = body[:len(body) // 2]
+        elif isinstance(failure, tuple):
+            status, headers, sent = failure[0], {'Retry-After': str(failure[1])}, b''
+        elif failure is not None:
+            status, headers, sent = failure, {}, b''
+
+        response = requests.Response()
+        response.status_code = status
+        response.reason = 'stand-in'
+        response.headers = requests.structures.CaseInsensitiveDict(headers)
+        response.raw = urllib3.HTTPResponse(body=io.BytesIO(sent), headers=headers, status=status,
+                                            preload_content=False)
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+    def count(self, url):
+        return sum(1 for requested, _ in self.requests if requested == url)
+
+
+@pytest.fixture
+def iem_server(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(iem.time, 'sleep', lambda seconds: sleeps.append(seconds) if seconds > 0 else None)
+
+    def serve(failures=None):
+        stand_in = StandInIEM(failures)
+        session = requests.Session()
+        session.mount(SERVER, stand_in)
+        return stand_in, session
+    return serve, sleeps
+
+
+def expected(tasks):
+    return pd.concat([pd.read_csv(io.BytesIO(csv(*task))) for task in tasks], ignore_index=True)
+
+
+def test_backoff_on_throttling(iem_server):
+    serve, sleeps = iem_server
+    stand_in, session = serve({url('KORD', 2020): [(429, 7), 503, 503]})
+    df = iem.fetch_csv(url('KORD', 2020), session)
+
+    pd.testing.assert_frame_equal(df, expected([('KORD', 2020)]))
+    assert stand_in.count(url('KORD', 2020)) == 4
+    # Retry-After when the server gives one, else exponential backoff
+    assert sleeps == [7., iem.RETRY_BACKOFF * 2, iem.RETRY_BACKOFF * 4]
+
+
+def test_gives_up_after_retries(iem_server, monkeypatch):
+    serve, sleeps = iem_server
+    monkeypatch.setattr(iem, 'MAX_RETRIES', 2)
+    stand_in, session = serve({url('KORD', 2020): [503] * 5})
+    with pytest.raises(requests.HTTPError):
+        iem.fetch_csv(url('KORD', 2020), session)
+    assert stand_in.count(url('KORD', 2020)) == 3
+
+
+def test_client_error_not_retried(iem_server):
+    serve, sleeps = iem_server
+    stand_in, session = serve({url('KORD', 2020): [404]})
+    with pytest.raises(requests.HTTPError):
+        iem.fetch_csv(url('KORD', 2020), session)
+    assert stand_in.count(url('KORD', 2020)) == 1 and sleeps == []
+
+
+def test_truncated_body_rejected(iem_server, monkeypatch):
+    serve, sleeps = iem_server
+    stand_in, session = serve({url('KORD', 2020): ['truncated']})
+    df = iem.fetch_csv(url('KORD', 2020), session)
+    # the half that did arrive is thrown away and the request made again
+    pd.testing.assert_frame_equal(df, expected([('KORD', 2020)]))
+    assert stand_in.count(url('KORD', 2020)) == 2
+
+    monkeypatch.setattr(iem, 'MAX_RETRIES', 1)
+    stand_in, session = serve({url('KORD', 2020): ['truncated'] * 2})
+    with pytest.raises(urllib3.exceptions.ProtocolError):
+        iem.fetch_csv(url('KORD', 2020), session)
+
+
+def test_resume_skips_finished_station_years(iem_server, monkeypatch, tmp_path):
+    serve, sleeps = iem_server
+    monkeypatch.setattr(iem, 'MAX_RETRIES', 1)
+    tasks = {f'{station}/{year}': url(station, year) for station in STATIONS for year in YEARS}
+    failing = url('KMDW', 2020)
+
+    stand_in, session = serve({failing: [503, 503]})
+    with pytest.raises(requests.HTTPError):
+        iem.download(tasks, str(tmp_path), session, rate=0, offline=False)
+    assert sorted(p.name for p in (tmp_path / 'KORD').iterdir()) == ['2019.parquet', '2020.parquet',
+                                                                      '2021.parquet']
+    assert not (tmp_path / 'KMDW' / '2020.parquet').exists()
+
+    stand_in, session = serve()
+    df = iem.download(tasks, str(tmp_path), session, rate=0, offline=False)
+    assert [requested for requested, _ in stand_in.requests] == [failing]
+    pd.testing.assert_frame_equal(df, expected([(s, y) for s in STATIONS for y in YEARS]))
+
+    # years asked to be refreshed are fetched again even though they're kept
+    stand_in, session = serve()
+    iem.download(tasks, str(tmp_path), session, rate=0, refresh=['KORD/2021'], offline=False)
+    assert [requested for requested, _ in stand_in.requests] == [url('KORD', 2021)]
+
+
+def test_rate_limit():
+    stand_in = StandInIEM()
+    session = requests.Session()
+    session.mount(SERVER, stand_in)
+    tasks = {f'{station}/{year}': url(station, year) for station in STATIONS for year in YEARS}
+
+    iem.download(tasks, session=session, max_workers=4, rate=20., offline=False)
+    starts = np.sort([t for _, t in stand_in.requests])
+    assert len(starts) == len(tasks)
+    # four workers, but requests still start 1/20 s apart (less some scheduling jitter)
+    assert starts[-1] - starts[0] >= (len(tasks) - 1) / 20. - 0.02
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from lib import ncep_r1
+from lib.cache import DatasetCache
+
+YEAR = pd.Timestamp.now().year
+
+
+# Stands in for the PSL year files, counting the pulls of each year
+@pytest.fixture
+def pulls(monkeypatch, tmp_path):
+    pulls = []
+
+    def open_year(year, folder, product, chunks=None):
+        pulls.append(year)
+        times = pd.date_range(f'{year}-01-01', periods=4, freq='D')
+        return xr.Dataset({'hgt': (('time', 'lat', 'lon'), np.full((4, 2, 3), float(len(pulls))))},
+                          coords={'time': times, 'lat': [10., 0.], 'lon': [0., 2.5, 5.]})
+
+    monkeypatch.setattr(ncep_r1, 'open_year', open_year)
+    monkeypatch.setattr(ncep_r1, 'CACHE', DatasetCache(str(tmp_path), offline=False))
+    monkeypatch.setattr(ncep_r1, 'USE_ARCHIVE', False)
+    monkeypatch.setattr(ncep_r1, 'USE_CACHE', True)
+    return pulls
+
+
+def load(year):
+    return ncep_r1._load_ncep(year, 'ncep.reanalysis.dailyavgs', 'pressure/hgt', {}, False)
+
+
+# moves every cache entry's write time `age` into the past
+def age_entries(cache, age):
+    with cache._updating():
+        for entry in cache.index.values():
+            entry['written'] -= pd.Timedelta(age).total_seconds()
+
+
+def test_current_year_refetched_after_refresh_age(pulls):
+    assert float(load(YEAR).hgt[0, 0, 0]) == 1
+    assert float(load(YEAR).hgt[0, 0, 0]) == 1
+    assert pulls == [YEAR]
+
+    age_entries(ncep_r1.CACHE, ncep_r1.REFRESH_AFTER + pd.Timedelta(1, 'min'))
+    assert float(load(YEAR).hgt[0, 0, 0]) == 2
+    assert pulls == [YEAR, YEAR]
+
+
+def test_complete_year_kept(pulls):
+    load(YEAR - 2)
+    age_entries(ncep_r1.CACHE, pd.Timedelta(30, 'D'))
+    load(YEAR - 2)
+    assert pulls == [YEAR - 2]
+
+
+def test_stale_current_year_used_offline(pulls):
+    load(YEAR)
+    age_entries(ncep_r1.CACHE, pd.Timedelta(30, 'D'))
+    ncep_r1.CACHE.offline = True
+    assert float(load(YEAR).hgt[0, 0, 0]) == 1
+    assert pulls == [YEAR]
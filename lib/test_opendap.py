@@ -0,0 +1,153 @@
+import io
+from urllib.parse import unquote, urlsplit
+
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+import xarray as xr
+from pydap.handlers.lib import BaseHandler
+from pydap.model import BaseType, DatasetType, GridType
+from webob import Request
+
+from lib import era5, opendap
+from lib.reanalysis import archive
+
+SERVER = 'https://rda.test/thredds/dodsC/files/g'
+DAY = pd.Timestamp('2021-01-01')
+LEVELS = np.array([500., 700., 850., 1000.])
+LATITUDES = np.arange(90., -90.1, -2.)
+LONGITUDES = np.arange(0., 360., 2.)
+
+
+# One day file of U on a 2 degree grid, as the xarray dataset and as pydap serves it
+def day_file(day=DAY):
+    times = pd.date_range(day, periods=24, freq='h')
+    values = np.random.default_rng(0).normal(size=(24, len(LEVELS), len(LATITUDES), len(LONGITUDES)))
+    ds = xr.Dataset({'U': (('time', 'level', 'latitude', 'longitude'), values.astype(np.float32))},
+                    coords={'time': times, 'level': LEVELS, 'latitude': LATITUDES, 'longitude': LONGITUDES})
+    return ds, served(ds)
+
+
+# `ds` (U on time, level, latitude and longitude) as a pydap dataset
+def served(ds):
+    start = pd.Timestamp(ds.time.values[0])
+    coords = {
+        'time': ((ds.time.values - ds.time.values[0]) / np.timedelta64(1, 'h'),
+                 {'units': f'hours since {start:%Y-%m-%d %H:%M:%S}'}),
+        'level': (ds.level.values, {}),
+        'latitude': (ds.latitude.values, {}),
+        'longitude': (ds.longitude.values, {}),
+    }
+    dataset = DatasetType('file')
+    for name, (data, attributes) in coords.items():
+        dataset[name] = BaseType(name, data, dimensions=(name,), attributes=attributes)
+    grid = GridType('U')
+    grid['U'] = BaseType('U', ds.U.values, dimensions=ds.U.dims)
+    for name, (data, attributes) in coords.items():
+        grid[name] = BaseType(name, data, dimensions=(name,), attributes=attributes)
+    dataset['U'] = grid
+    return dataset
+
+
+# Answers requests to SERVER from pydap handlers of in-memory datasets, keyed by
+# file path, recording each URL and the bytes sent. Files it doesn't have are 404s,
+# as for days RDA hasn't published yet.
+class StandInServer(requests.adapters.BaseAdapter):
+    def __init__(self, datasets):
+        super().__init__()
+        self.datasets = datasets
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        path = urlsplit(request.url).path[len(urlsplit(SERVER).path):]
+        base = path.rpartition('.')[0]
+        if base not in self.datasets:
+            self.requests.append((unquote(request.url), 0))
+            return _response(request, 404, 'Not Found', {}, b'')
+        wsgi = Request.blank(request.url).get_response(BaseHandler(self.datasets[base]))
+        self.requests.append((unquote(request.url), len(wsgi.body)))
+        return _response(request, wsgi.status_code, wsgi.status.split(' ', 1)[1], wsgi.headerlist, wsgi.body)
+
+    def close(self):
+        pass
+
+    # constraint expressions of the requests for U values (coordinates are read
+    # whole, as xarray indexes them on opening)
+    def data_requests(self):
+        return [url.split('?', 1)[1] for url, _ in self.requests if '.dods?U.' in url]
+
+
+def _response(request, status_code, reason, headers, body):
+    response = requests.Response()
+    response.status_code = status_code
+    response.reason = reason
+    response.headers = requests.structures.CaseInsensitiveDict(headers)
+    response.raw = io.BytesIO(body)
+    response.url = request.url
+    response.request = request
+    return response
+
+
+@pytest.fixture
+def server(monkeypatch, tmp_path):
+    ds, dataset = day_file()
+    path = era5.pl_daily_url(DAY, era5.PL_VARS.U_WIND)[len(era5.RDA_THREDDS_URL):]
+    monkeypatch.setattr(era5, 'RDA_THREDDS_URL', SERVER)
+    monkeypatch.setattr(archive, 'ARCHIVE_DIR', str(tmp_path))
+    opendap.TRANSFERS.clear()
+
+    stand_in = StandInServer({path: dataset})
+    session = requests.Session()
+    session.mount(SERVER, stand_in)
+    return ds, stand_in, session
+
+
+def test_hyperslab_pushdown(server):
+    ds, stand_in, session = server
+    result = era5.era5_pl_daily(DAY, era5.PL_VARS.U_WIND, session, bbox=(-130, -60, 56, 20), levels=[850],
+                                hours=[0, 12])
+    u = result.U.load()
+
+    # 56N-20N is rows 17-35, 230-300E columns 115-150
+    assert stand_in.data_requests() == ['U.U[0:12:12][2:1:2][17:1:35][115:1:150]']
+    expected = ds.U.sel(time=ds.time[[0, 12]], level=[850], latitude=slice(56, 20), longitude=slice(230, 300))
+    np.testing.assert_array_equal(u.values, expected.values)
+    np.testing.assert_array_equal(u.longitude.values, np.arange(-130., -59., 2.))
+
+
+def test_seam_crossing_box(server):
+    ds, stand_in, session = server
+    result = era5.era5_pl_daily(DAY, era5.PL_VARS.U_WIND, session, bbox=(-20, 20, 10, -10), levels=[500, 1000])
+    u = result.U.load()
+
+    # one read for each side of the 0/360 seam, west side first
+    assert sorted(stand_in.data_requests()) == sorted([
+        'U.U[0:1:23][0:3:3][40:1:50][170:1:179]',
+        'U.U[0:1:23][0:3:3][40:1:50][0:1:10]',
+    ])
+    expected = ds.U.sel(level=[500, 1000], latitude=slice(10, -10)).roll(longitude=10, roll_coords=True)
+    np.testing.assert_array_equal(u.values, expected.isel(longitude=slice(0, 21)).values)
+    np.testing.assert_array_equal(u.longitude.values, np.arange(-20., 21., 2.))
+
+
+def test_transfer_accounting(server):
+    ds, stand_in, session = server
+    result = era5.era5_pl_daily(DAY, era5.PL_VARS.U_WIND, session, bbox=(-130, -60, 56, 20), levels=[850])
+    transfer = opendap.TRANSFERS[-1]
+    assert transfer.url == era5.pl_daily_url(DAY, era5.PL_VARS.U_WIND)
+    assert transfer.estimated == result.nbytes
+
+    metadata = sum(nbytes for _, nbytes in stand_in.requests)
+    assert transfer.received == metadata
+    result.load()
+    assert transfer.received == sum(nbytes for _, nbytes in stand_in.requests) > metadata
+    assert transfer.requests == len(stand_in.requests)
+    # the DAP response carries the U values and little else
+    assert transfer.received - metadata < 1.1 * result.U.nbytes + 1000
+
+    report = opendap.report()
+    assert list(report.index) == [transfer.url]
+    assert report.loc[transfer.url, 'received_mb'] == transfer.received / 1e6
+    assert report.loc[transfer.url, 'estimated_mb'] == transfer.estimated / 1e6
+    assert report.loc[transfer.url, 'requests'] == transfer.requests
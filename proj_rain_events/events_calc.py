@@ -1,48 +1,77 @@
-from sklearn.metrics import pairwise_distances
-from sklearn.cluster import DBSCAN
-import pandas as pd
 import numpy as np
 
+NS_PER_HOUR = 3.6e12
 
+
+# Equivalent to DBSCAN(eps, min_samples) over the hourly distances between `valid`
+# timestamps, weighted by precip_in / 0.01. Since the points are 1-D, neighborhoods
+# are contiguous windows of the sorted times and can be found with searchsorted
+# instead of a full pairwise distance matrix. `chunks` is kept for compatibility
+# with older notebooks and is no longer needed.
 def precip_events(df, eps, min_samples, chunks=None):
-    if not chunks or eps >= chunks:
-        return find_hourly_precip_clusts(df, eps, min_samples)
+    return find_hourly_precip_clusts(df, eps, min_samples)
 
-    max_cluster = 0
-    result = []
-    for chunk in _partition(df, chunks, eps):
-        clusts = find_hourly_precip_clusts(chunk, eps, min_samples)
-        clusts += np.where(clusts < 0, 0, max_cluster)
-        result.append(clusts)
-        max_cluster = clusts.max() + 1
 
-    return np.concatenate(result)
+def find_hourly_precip_clusts(df, eps, min_samples):
+    n = len(df)
+    labels = np.full(n, -1, dtype=np.int64)
+    if n == 0:
+        return labels
 
+    times = df.valid.values.astype('datetime64[ns]').astype(np.int64)
+    orig_weights = df.precip_in.values.astype(np.float64) / 0.01
 
-def _partition(df, chunks, eps):
-    chunk_size = int(np.ceil((len(df) + 1) / chunks))
-    diffs = df.valid.diff(1)
-    diffs = diffs[diffs > pd.Timedelta(eps, 'h')]
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    weights = orig_weights[order]
 
-    init = 0
-    max_index_df = df.index.max()
-    while init <= max_index_df:
-        next_index = diffs.index[diffs.index.get_loc(init + chunk_size, method='nearest')]
-        # print(f'init: {init}, next index: {next_index}')
-        if next_index == init:
-            next_index = max_index_df + 1
-        yield df.loc[init:next_index - 1]
-        init = next_index
+    eps_ns = np.int64(np.floor(eps * NS_PER_HOUR))
+    lo = np.searchsorted(times, times - eps_ns, side='left')
+    hi = np.searchsorted(times, times + eps_ns, side='right')
 
+    cum_weights = np.concatenate([[0.], np.cumsum(weights)])
+    neighborhood_weights = cum_weights[hi] - cum_weights[lo]
 
-def find_hourly_precip_clusts(df, eps, min_samples):
-    def to_hour(ns):
-        return abs(ns / 3.6e12)
-
-    dists = pairwise_distances(
-        df.valid.values.reshape(-1, 1),
-        metric=lambda x, y: to_hour(y - x),
-    )
-    db = DBSCAN(eps=eps, metric='precomputed', min_samples=min_samples)
-    clusts = db.fit_predict(dists, sample_weight=df.precip_in.values / 0.01)
-    return clusts
\ No newline at end of file
+    # Re-sum windows that land right at the threshold the same way DBSCAN does, so
+    # floating point roundoff (e.g. 0.03 / 0.01) decides them identically.
+    borderline = np.flatnonzero(np.isclose(neighborhood_weights, min_samples))
+    for i in borderline:
+        neighbors = np.sort(order[lo[i]:hi[i]])
+        neighborhood_weights[i] = np.sum(orig_weights[neighbors])
+
+    is_core = neighborhood_weights >= min_samples
+    if not is_core.any():
+        return labels
+
+    # Consecutive core points within eps of each other belong to the same cluster.
+    core_pos = np.flatnonzero(is_core)
+    core_times = times[core_pos]
+    new_clust = np.concatenate([[True], np.diff(core_times) > eps_ns])
+    core_clust = np.cumsum(new_clust) - 1
+
+    # DBSCAN numbers clusters by the first (in input order) core point it visits.
+    first_seen = np.full(core_clust[-1] + 1, n, dtype=np.int64)
+    np.minimum.at(first_seen, core_clust, order[core_pos])
+    relabel = np.empty_like(first_seen)
+    relabel[np.argsort(first_seen)] = np.arange(len(first_seen))
+    core_labels = relabel[core_clust]
+
+    # Border points join the cluster of the nearest core point on either side that
+    # lies within eps, preferring the one DBSCAN would have expanded first.
+    num_core = len(core_times)
+    left = np.searchsorted(core_times, times, side='right') - 1
+    right = left + 1
+    left_idx = np.clip(left, 0, num_core - 1)
+    right_idx = np.clip(right, 0, num_core - 1)
+    left_ok = (left >= 0) & (times - core_times[left_idx] <= eps_ns)
+    right_ok = (right < num_core) & (core_times[right_idx] - times <= eps_ns)
+
+    no_label = np.iinfo(np.int64).max
+    left_labels = np.where(left_ok, core_labels[left_idx], no_label)
+    right_labels = np.where(right_ok, core_labels[right_idx], no_label)
+    sorted_labels = np.minimum(left_labels, right_labels)
+    sorted_labels[sorted_labels == no_label] = -1
+    sorted_labels[core_pos] = core_labels
+
+    labels[order] = sorted_labels
+    return labels
@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+
+
+# Per-row precip accumulated over the trailing `hours` (t - hours, t] within each
+# event, i.e. the "past 24 hour precip" column, in one vectorized pass. Rows with
+# a negative (noise) label get NaN. Returned series is aligned to df.index.
+def trailing_precip(df, clusts, hours=24):
+    grouped = _EventGroups(df, clusts)
+    result = np.full(len(df), np.nan)
+    result[grouped.rows] = grouped.trailing(hours)
+    return pd.Series(result, index=df.index, name=f'precip_in_{hours}hr')
+
+
+# One row per event with total precip, start/end/mean/precip-weighted centroid
+# times, peak hourly rate, and the max trailing accumulation (and when it ended)
+# for each of the window lengths in `windows`.
+def summarize_events(df, clusts, windows=(24,)):
+    grouped = _EventGroups(df, clusts)
+    starts = grouped.starts
+    precip = grouped.precip
+    times = grouped.times
+    rel_times = (times - grouped.start_times[grouped.codes]).astype(np.float64)
+
+    total = np.add.reduceat(precip, starts)
+    mean_offset = np.add.reduceat(rel_times, starts) / grouped.counts
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centroid_offset = np.add.reduceat(rel_times * precip, starts) / total
+    centroid_offset = np.where(np.isfinite(centroid_offset), centroid_offset, mean_offset)
+
+    result = pd.DataFrame({
+        'clust': grouped.labels,
+        'precip': total,
+        'mean_time': _to_datetime(grouped.start_times + mean_offset.round().astype(np.int64)),
+        'centroid_time': _to_datetime(grouped.start_times + centroid_offset.round().astype(np.int64)),
+        'min_time': _to_datetime(grouped.start_times),
+        'max_time': _to_datetime(np.maximum.reduceat(times, starts)),
+        'max_rate': np.maximum.reduceat(precip, starts),
+    })
+
+    for hours in windows:
+        accum = grouped.trailing(hours)
+        peak_rows = grouped.first_max(accum)
+        result[f'max_precip_{hours}hr'] = accum[peak_rows]
+        result[f'max_precip_{hours}hr_time'] = _to_datetime(times[peak_rows])
+
+    return result
+
+
+class _EventGroups(object):
+    def __init__(self, df, clusts):
+        clusts = np.asarray(clusts)
+        all_times = df.valid.values.astype('datetime64[ns]').astype(np.int64)
+        all_precip = df.precip_in.values.astype(np.float64)
+
+        in_event = np.flatnonzero(clusts >= 0)
+        order = np.lexsort((all_times[in_event], clusts[in_event]))
+        self.rows = in_event[order]
+
+        sorted_clusts = clusts[self.rows]
+        self.times = all_times[self.rows]
+        self.precip = all_precip[self.rows]
+
+        self.labels, self.starts, self.counts = np.unique(sorted_clusts, return_index=True, return_counts=True)
+        self.codes = np.repeat(np.arange(len(self.labels)), self.counts)
+        self.start_times = self.times[self.starts]
+
+        # Lay events end to end on one monotonic axis so a single searchsorted finds
+        # every row's window start; windows are then clipped to their own event.
+        spans = np.maximum.reduceat(self.times, self.starts) - self.start_times
+        offsets = np.concatenate([[0], np.cumsum(spans)[:-1]])
+        self._axis = self.times - self.start_times[self.codes] + offsets[self.codes]
+        self._cum_precip = np.concatenate([[0.], np.cumsum(self.precip)])
+
+    def trailing(self, hours):
+        window = np.int64(round(pd.Timedelta(hours, 'h').value))
+        left = np.searchsorted(self._axis, self._axis - window, side='right')
+        left = np.maximum(left, self.starts[self.codes])
+        right = np.arange(1, len(self._axis) + 1)
+        # round off the cumulative-sum error so equal accumulations compare equal
+        return np.round(self._cum_precip[right] - self._cum_precip[left], 6)
+
+    # index of the first row (in time) holding each event's maximum of `values`
+    def first_max(self, values):
+        by_value = np.lexsort((np.arange(len(values)), -values, self.codes))
+        return by_value[self.starts]
+
+
+def _to_datetime(ns):
+    return pd.to_datetime(np.asarray(ns, dtype=np.int64).astype('datetime64[ns]'))
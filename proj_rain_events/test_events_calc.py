@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.cluster import DBSCAN
+
+from events_calc import find_hourly_precip_clusts, precip_events
+
+
+# The pairwise DBSCAN clustering the sorted sweep replaced, with the hourly
+# distances computed all at once
+def dbscan_clusts(df, eps, min_samples):
+    ns = df.valid.values.astype('datetime64[ns]').astype(np.int64)
+    dists = np.abs((ns[np.newaxis, :] - ns[:, np.newaxis]) / 3.6e12)
+    db = DBSCAN(eps=eps, metric='precomputed', min_samples=min_samples)
+    return db.fit_predict(dists, sample_weight=df.precip_in.values / 0.01)
+
+
+# Hourly precip with rainy spells and gaps, in hundredths of an inch (so weights
+# land exactly on min_samples), optionally shuffled
+def random_hours(rng, n, shuffle=False):
+    gaps = rng.choice([1, 1, 1, 2, 3, 6, 12, 30], size=n)
+    valid = pd.Timestamp('2000-01-01') + pd.to_timedelta(np.cumsum(gaps), 'h')
+    precip = rng.choice([0.01, 0.01, 0.02, 0.03, 0.05, 0.1, 0.25], size=n)
+    df = pd.DataFrame({'valid': valid, 'precip_in': precip})
+    if shuffle:
+        df = df.sample(frac=1, random_state=rng.integers(1 << 31)).reset_index(drop=True)
+    return df
+
+
+@pytest.mark.parametrize('seed', range(400))
+def test_matches_dbscan(seed):
+    rng = np.random.default_rng(seed)
+    df = random_hours(rng, rng.integers(1, 80), shuffle=seed % 2 == 1)
+    eps = float(rng.choice([1, 1.5, 2, 3, 6, 12]))
+    min_samples = int(rng.choice([1, 2, 3, 5, 10, 25]))
+
+    np.testing.assert_array_equal(find_hourly_precip_clusts(df, eps, min_samples),
+                                  dbscan_clusts(df, eps, min_samples))
+
+
+# 0.01 + 0.02 sums to just over 0.03, and DBSCAN's own sum decides the tie
+def test_borderline_weights():
+    df = pd.DataFrame({'valid': pd.date_range('2000-01-01', periods=3, freq='h'),
+                       'precip_in': [0.01, 0.02, 0.03]})
+    for min_samples in (3, 5, 6):
+        np.testing.assert_array_equal(find_hourly_precip_clusts(df, 1, min_samples),
+                                      dbscan_clusts(df, 1, min_samples))
+
+
+def test_chunks_ignored():
+    df = random_hours(np.random.default_rng(0), 200)
+    np.testing.assert_array_equal(precip_events(df, 3, 5, chunks=4), precip_events(df, 3, 5))
+
+
+def test_empty():
+    df = pd.DataFrame({'valid': pd.DatetimeIndex([]), 'precip_in': np.array([], dtype=np.float64)})
+    assert len(find_hourly_precip_clusts(df, 3, 5)) == 0
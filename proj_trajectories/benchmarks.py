@@ -0,0 +1,132 @@
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from trajectories import WindField, back_trajectory, back_trajectories, sel, _distance_km
+
+ERA5_LEVELS = [500, 550, 600, 650, 700, 750, 775, 800, 825, 850, 875, 900, 925, 950, 975, 1000]
+
+
+# ERA5-shaped (time, level, latitude, longitude) U/V/W/T datasets with smooth,
+# time-varying synthetic winds, so benchmarks don't need RDA credentials.
+def synthetic_fields(start='1985-01-18', periods=25, freq='3h', res=1.0):
+    time_ = pd.date_range(start, periods=periods, freq=freq)
+    level = np.array(ERA5_LEVELS, dtype=np.float64)
+    lat = np.arange(90, -90 - res / 2, -res)
+    lon = np.arange(0, 360, res)
+    t, lev, y, x = np.meshgrid(np.arange(periods), level, np.radians(lat), np.radians(lon), indexing='ij')
+
+    def to_ds(name, values):
+        return xr.Dataset({name: (('time', 'level', 'latitude', 'longitude'), values.astype(np.float32))},
+                          coords={'time': time_, 'level': level, 'latitude': lat, 'longitude': lon})
+
+    u = to_ds('U', 20 * np.cos(y) + 5 * np.sin(2 * x + 0.1 * t) + (1000 - lev) / 50)
+    v = to_ds('V', 8 * np.sin(3 * x - 0.05 * t) * np.cos(y))
+    w = to_ds('W', 0.03 * np.sin(x + y + 0.2 * t))
+    T = to_ds('T', 250 + 30 * np.cos(y) - (1000 - lev) / 20)
+    return u, v, w, T
+
+
+def bench_back_trajectories(nparcels=(1, 10, 100, 1000, 10000), nsteps=15, level=700):
+    u, v, w, T = synthetic_fields()
+    end = u.time.values[-1]
+    times = [pd.Timestamp(end) - 3 * pd.Timedelta(n, 'h') for n in range(nsteps)]
+    rng = np.random.default_rng(0)
+
+    start = time.perf_counter()
+    single = back_trajectory((34.7465, -92.2896), level, times, u, v, w, T)
+    single_secs = time.perf_counter() - start
+    print(f'back_trajectory: 1 parcel, {single_secs:.3f} s')
+
+    batched = back_trajectories([34.7465], [-92.2896], [level], times, u, v, w, T)
+    single_pts = np.array(list(single.values()))
+    max_diff = np.nanmax(np.abs(single_pts[:, 0] - batched.lat.values[0]))
+    print(f'back_trajectories vs back_trajectory: max lat difference {max_diff:.2e} deg')
+
+    for n in nparcels:
+        lats = rng.uniform(25, 60, n)
+        lons = rng.uniform(-130, -70, n)
+        start = time.perf_counter()
+        back_trajectories(lats, lons, level, times, u, v, w, T)
+        secs = time.perf_counter() - start
+        print(f'back_trajectories: {n} parcels, {secs:.3f} s '
+              f'({secs / n * 1e3:.3f} ms/parcel, {single_secs * n / secs:.0f}x back_trajectory)')
+
+
+def bench_wind_lookups(nlookups=200):
+    u, v, w, T = synthetic_fields()
+    t = pd.Timestamp(u.time.values[len(u.time) // 2])
+    rng = np.random.default_rng(0)
+    pts = np.column_stack([rng.uniform(25, 60, nlookups), rng.uniform(-130, -70, nlookups),
+                           rng.uniform(600, 900, nlookups)])
+
+    start = time.perf_counter()
+    for lat, lon, lev in pts:
+        float(sel(u.U, t, lon, lat, lev))
+    print(f'sel: {(time.perf_counter() - start) / nlookups * 1e6:.0f} us/lookup')
+
+    start = time.perf_counter()
+    field = WindField(u, v, w)
+    print(f'WindField: built in {time.perf_counter() - start:.3f} s')
+
+    start = time.perf_counter()
+    for lat, lon, lev in pts:
+        field.interp('U', t, lat, lon, lev)
+    print(f'WindField.interp: {(time.perf_counter() - start) / nlookups * 1e6:.1f} us/lookup')
+
+    start = time.perf_counter()
+    field.interp('U', t, pts[:, 0], pts[:, 1], pts[:, 2])
+    print(f'WindField.interp (batch): {(time.perf_counter() - start) / nlookups * 1e6:.2f} us/lookup')
+
+
+class _CountingWindField(WindField):
+    calls = 0
+
+    def winds(self, t, lat, lon, lev):
+        self.calls += 1
+        return super().winds(t, lat, lon, lev)
+
+
+# Error vs. cost of the time stepping options, for 72 h back trajectories output
+# every 12 h. The reference is RK4 with 5 minute steps; the error is the mean
+# great circle distance from it at the final time.
+def bench_time_stepping(nparcels=500, level=700):
+    u, v, w, T = synthetic_fields()
+    field = _CountingWindField(u, v, w)
+    end = pd.Timestamp(u.time.values[-1])
+    times = [end - pd.Timedelta(n, 'h') for n in range(0, 73, 12)]
+    rng = np.random.default_rng(0)
+    lats, lons = rng.uniform(25, 60, nparcels), rng.uniform(-130, -70, nparcels)
+
+    ref = field.back_trajectories(lats, lons, level, times, method='rk4', substeps=144).isel(time=-1)
+
+    configs = [
+        ('petterssen', {'substeps': 4}),
+        ('petterssen', {'substeps': 12}),
+        ('petterssen', {'substeps': 48}),
+        ('rk4', {'substeps': 1}),
+        ('rk4', {'substeps': 2}),
+        ('rk4', {'substeps': 4}),
+        ('petterssen', {'tolerance': 1.}),
+        ('rk4', {'tolerance': 1.}),
+        ('rk4', {'tolerance': 0.1}),
+    ]
+    for method, kw in configs:
+        field.calls = 0
+        start = time.perf_counter()
+        result = field.back_trajectories(lats, lons, level, times, method=method, **kw).isel(time=-1)
+        secs = time.perf_counter() - start
+        err = _distance_km((result.lat.values, result.lon.values), (ref.lat.values, ref.lon.values))
+        print(f'{method} {kw}: {field.calls} wind reads, {secs:.3f} s, mean error {np.nanmean(err):.3f} km')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        bench_back_trajectories(nparcels=[int(n) for n in sys.argv[1:]])
+    else:
+        bench_back_trajectories()
+    bench_wind_lookups()
+    bench_time_stepping()
@@ -0,0 +1,134 @@
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from trajectories import WindField
+
+
+# Runs back trajectories for many (start point, arrival time) jobs.
+#
+# `jobs` is a DataFrame with lat, lon, level and time (arrival) columns; its index
+# identifies each job in the output. Jobs arriving at the same time share one wind
+# field, loaded in the parent by `load_field(tmin, tmax)`, which returns a WindField
+# from the data time at or before tmin to the one at or after tmax (as
+# WindField(u, v, w, times=(tmin, tmax)) does), e.g. built from lib.era5 pulls; a
+# field that doesn't reach that far raises ValueError. The field's arrays are
+# written once to memory-mapped files which the worker processes map read-only, so
+# workers never each hold a copy of the reanalysis data. Each case's parcels are
+# split into chunks of `chunk_size` and fanned out across `processes` workers, and
+# finished cases are streamed to `sink` (see ParquetSink / NetCDFSink).
+#
+# Other keyword arguments (method, substeps, tolerance) go to
+# WindField.back_trajectories.
+#
+# Returns the total number of parcel-steps integrated and the throughput in
+# parcel-steps per second.
+def run_ensemble(jobs, load_field, sink, hours=72, step_hours=3, processes=None,
+                 chunk_size=1000, tmpdir=None, **kwargs):
+    nsteps = int(hours // step_hours)
+    total_parcel_steps = 0
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for arrival, case_jobs in jobs.groupby('time'):
+            arrival = pd.Timestamp(arrival)
+            times = [arrival - step_hours * pd.Timedelta(n, 'h') for n in range(nsteps + 1)]
+            case_start = time.perf_counter()
+
+            field = load_field(times[-1], times[0])
+            _check_covers(field, times[-1], times[0])
+            with SharedWindField(field, tmpdir) as shared:
+                futures = []
+                for lo in range(0, len(case_jobs), chunk_size):
+                    chunk = case_jobs.iloc[lo:lo + chunk_size]
+                    futures.append(pool.submit(_run_chunk, shared.spec, chunk.lat.values,
+                                               chunk.lon.values, chunk.level.values, times, kwargs))
+                results = [future.result() for future in futures]
+
+            ds = xr.concat(results, dim='parcel')
+            ds = ds.assign_coords(parcel=case_jobs.index.values).rename(parcel='job')
+            sink.write(ds)
+
+            parcel_steps = len(case_jobs) * nsteps
+            total_parcel_steps += parcel_steps
+            secs = time.perf_counter() - case_start
+            print(f'{arrival}: {len(case_jobs)} parcels, {parcel_steps / secs:.0f} parcel-steps/s')
+
+    rate = total_parcel_steps / (time.perf_counter() - start)
+    print(f'Finished {total_parcel_steps} parcel-steps at {rate:.0f} parcel-steps/s')
+    return total_parcel_steps, rate
+
+
+def _check_covers(field, tmin, tmax):
+    data_times = field.coords['time']
+    if len(data_times) == 0 or data_times[0] > tmin.to_datetime64() or data_times[-1] < tmax.to_datetime64():
+        raise ValueError(f'load_field({tmin}, {tmax}) must return winds from at or before {tmin} '
+                         f'to at or after {tmax}')
+
+
+def _run_chunk(spec, lats, lons, levels, times, kwargs):
+    field = SharedWindField.attach(spec)
+    return field.back_trajectories(lats, lons, levels, times, **kwargs)
+
+
+# Copies a WindField's arrays into .npy files under a temporary directory (by
+# default in /dev/shm when available, so pages stay in RAM) and hands workers a
+# small picklable spec to memory-map them. Files are removed on exit.
+class SharedWindField(object):
+    def __init__(self, field, tmpdir=None):
+        if tmpdir is None and os.path.isdir('/dev/shm'):
+            tmpdir = '/dev/shm'
+        self.directory = tempfile.mkdtemp(prefix='windfield-', dir=tmpdir)
+
+        paths = {}
+        for name, values in field.values.items():
+            paths[name] = os.path.join(self.directory, f'{name}.npy')
+            np.save(paths[name], values)
+        self.spec = {'paths': paths, 'coords': field.coords}
+
+    @staticmethod
+    def attach(spec):
+        values = {name: np.load(path, mmap_mode='r') for name, path in spec['paths'].items()}
+        coords = spec['coords']
+        return WindField.from_arrays(values, *(coords[dim] for dim in WindField.DIMS))
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Writes each case as a tidy (job, time) table to a numbered part file in
+# `directory`, which pd.read_parquet(directory) reads back as one frame.
+class ParquetSink(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self._part = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, ds):
+        df = ds.to_dataframe().reset_index()
+        df.to_parquet(os.path.join(self.directory, f'part-{self._part:05d}.parquet'), index=False)
+        self._part += 1
+
+
+# Writes each case as its own (job, time) NetCDF file in `directory`.
+class NetCDFSink(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self._part = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, ds):
+        ds.to_netcdf(os.path.join(self.directory, f'part-{self._part:05d}.nc'))
+        self._part += 1
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from ensemble import run_ensemble
+from trajectories import WindField, back_trajectories, back_trajectory, calc_step
+
+LEVELS = [500., 600., 700., 800., 900., 1000.]
+
+
+# U, V, W datasets of uniform winds (m/s, m/s, Pa/s) on a 3 hourly, 1 degree grid
+def uniform_fields(u=0., v=0., w=0., periods=9, freq='3h'):
+    coords = {'time': pd.date_range('2021-01-01', periods=periods, freq=freq), 'level': LEVELS,
+              'latitude': np.arange(60., 19., -1.), 'longitude': np.arange(200., 301., 1.)}
+    shape = tuple(len(values) for values in coords.values())
+
+    def to_ds(name, value):
+        return xr.Dataset({name: (tuple(coords), np.full(shape, value))}, coords=coords)
+
+    return to_ds('U', u), to_ds('V', v), to_ds('W', w)
+
+
+# w > 0 is sinking: traced back, the parcel came from lower pressure; forward, it
+# goes to higher pressure
+@pytest.mark.parametrize('w, back_sign', [(0.5, -1), (-0.5, 1)])
+def test_calc_step_vertical_direction(w, back_sign):
+    dt = pd.Timedelta(2, 'h')
+    assert calc_step(0., 0., w, -100., 40., 700., dt)[2] == pytest.approx(700. + back_sign * abs(w) * 36 * 2)
+    assert calc_step(0., 0., w, -100., 40., 700., dt, back=False)[2] == pytest.approx(700. + w * 36 * 2)
+
+
+@pytest.mark.parametrize('w', [0.25, -0.25])
+def test_back_trajectories_vertical_direction(w):
+    u, v, w_ = uniform_fields(w=w)
+    end = pd.Timestamp(u.time.values[-1])
+    times = [end - pd.Timedelta(n, 'h') for n in (0, 6, 12)]
+    expected = [700., 700. - w * 36 * 6, 700. - w * 36 * 12]
+
+    single = back_trajectory((40., -110.), 700., times, u, v, w_)
+    np.testing.assert_allclose([point[2] for point in single.values()], expected)
+    field = WindField(u, v, w_)
+    for method in ('petterssen', 'rk4'):
+        result = field.back_trajectories([40.], [-110.], 700., times, method=method)
+        np.testing.assert_allclose(result.level.values[0], expected)
+
+
+# Output times off the 3 hourly data times, at either end: the field is cropped
+# to the data times around them, so the last substeps still find winds.
+@pytest.mark.parametrize('hours', [(0, 5, 10, 13), (1, 5, 10, 13)])
+@pytest.mark.parametrize('method', ['petterssen', 'rk4'])
+def test_back_trajectories_off_grid_times(hours, method):
+    u, v, w = uniform_fields(v=-3.)
+    end = pd.Timestamp(u.time.values[-1])
+    times = [end - pd.Timedelta(n, 'h') for n in hours]
+
+    cropped = back_trajectories([40.], [-110.], 700., times, u, v, w, method=method, substeps=4)
+    whole = WindField(u, v, w).back_trajectories([40.], [-110.], 700., times, method=method, substeps=4)
+    assert not np.isnan(cropped.lat.values).any()
+    np.testing.assert_allclose(cropped.lat.values, whole.lat.values)
+
+
+class ListSink(object):
+    def __init__(self):
+        self.cases = []
+
+    def write(self, ds):
+        self.cases.append(ds)
+
+
+def test_run_ensemble_off_grid_arrival():
+    u, v, w = uniform_fields(v=-3.)
+    arrival = pd.Timestamp(u.time.values[-1]) - pd.Timedelta(1, 'h')
+    jobs = pd.DataFrame({'lat': [40.], 'lon': [-110.], 'level': [700.], 'time': [arrival]})
+    sink = ListSink()
+    run_ensemble(jobs, lambda tmin, tmax: WindField(u, v, w, times=(tmin, tmax)), sink, hours=13, step_hours=6.5,
+                 processes=1, substeps=4, method='rk4')
+    assert not np.isnan(sink.cases[0].lat.values).any()
+
+    # a loader that stops short of the data time before tmin
+    def short(tmin, tmax):
+        return WindField(*(ds.sel(time=slice(tmin, tmax)) for ds in (u, v, w)))
+    with pytest.raises(ValueError):
+        run_ensemble(jobs, short, ListSink(), hours=13, step_hours=6.5, processes=1)
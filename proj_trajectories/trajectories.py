@@ -1,7 +1,10 @@
+import math
 from collections import OrderedDict
+from itertools import product
 
 import pandas as pd
 import numpy as np
+import xarray as xr
 
 
 def back_trajectory(latlon, level, times, u, v, w, T=None):
@@ -42,6 +45,315 @@ def back_trajectory(latlon, level, times, u, v, w, T=None):
     return result
 
 
+# Same predictor-corrector scheme as back_trajectory, but advances arrays of parcels
+# at once against a WindField (built from u, v, w, T here, or reused across calls via
+# WindField.back_trajectories). Returns a Dataset of lat, lon, level (and T) with
+# dims (parcel, time); parcels leaving the loaded grid become NaN.
+def back_trajectories(lats, lons, levels, times, u, v, w, T=None, **kwargs):
+    times = [pd.Timestamp(t) for t in times]
+    field = WindField(u, v, w, T, times=(min(times), max(times)))
+    return field.back_trajectories(lats, lons, levels, times, **kwargs)
+
+
+# In-memory U/V/W (and optionally T) on their shared (time, level, latitude,
+# longitude) grid. Data is loaded once, optionally subset to a time range (widened
+# to the data times on either side of it, so times between data times interpolate),
+# a (west, east, south, north) box and a list of levels, and every lookup afterwards
+# is index arithmetic on contiguous arrays: linear in all four dimensions, with
+# the 0-360 longitude wrap and descending latitudes handled by the axes. Points
+# outside the loaded grid interpolate to NaN.
+class WindField(object):
+    DIMS = ('time', 'level', 'latitude', 'longitude')
+    STEPPERS = {'petterssen': '_petterssen_step', 'rk4': '_rk4_step'}
+
+    def __init__(self, u, v, w, T=None, times=None, bbox=None, levels=None):
+        arrays = {'U': u.U, 'V': v.V, 'W': w.W}
+        if T:
+            arrays['T'] = T.T
+
+        values = {}
+        for name, da in arrays.items():
+            da = _subset(da, times, bbox, levels).transpose(*self.DIMS)
+            values[name] = np.ascontiguousarray(da.values, dtype=np.float64)
+
+        self._init_grid(values, *(da[dim].values for dim in self.DIMS))
+
+    # Builds a field directly from (time, level, latitude, longitude) arrays, e.g.
+    # views onto shared memory, without copying them.
+    @classmethod
+    def from_arrays(cls, values, time, level, latitude, longitude):
+        field = cls.__new__(cls)
+        field._init_grid(values, time, level, latitude, longitude)
+        return field
+
+    def _init_grid(self, values, time, level, latitude, longitude):
+        self.values = values
+        self.coords = {'time': np.asarray(time).astype('datetime64[ns]'), 'level': np.asarray(level),
+                       'latitude': np.asarray(latitude), 'longitude': np.asarray(longitude)}
+
+        time_ns = self.coords['time'].astype(np.int64)
+        self.time = _Axis(time_ns.astype(np.float64))
+        self.level = _Axis(self.coords['level'])
+        self.latitude = _Axis(self.coords['latitude'])
+        self.longitude = _Axis(self.coords['longitude'], wrap=360)
+
+    @property
+    def has_temperature(self):
+        return 'T' in self.values
+
+    def interp(self, name, t, lat, lon, lev):
+        return self.interp_many((name,), t, lat, lon, lev)[0]
+
+    def winds(self, t, lat, lon, lev):
+        return self.interp_many(('U', 'V', 'W'), t, lat, lon, lev)
+
+    # Scalars in, floats out; arrays in, arrays out. Interpolation weights are
+    # computed once and shared by all requested variables.
+    def interp_many(self, names, t, lat, lon, lev):
+        if all(np.ndim(x) == 0 for x in (lat, lon, lev)):
+            return self._interp_point(names, t, float(lat), float(lon), float(lev))
+
+        lat, lon, lev = np.broadcast_arrays(*(np.asarray(x, dtype=np.float64) for x in (lat, lon, lev)))
+        t = np.full(lat.shape, float(pd.Timestamp(t).value))
+        locs = [axis.locate(x) for axis, x in ((self.time, t), (self.level, lev),
+                                                 (self.latitude, lat), (self.longitude, lon))]
+        valid = np.logical_and.reduce([loc[3] for loc in locs])
+
+        # bracketing indices and weights for each dimension, shaped so that indexing
+        # gathers all 16 surrounding grid values at once as (2, 2, 2, 2, *shape)
+        idx, weight = [], 1
+        for dim, (lo, hi, frac, _) in enumerate(locs):
+            shape = [1] * 4 + list(lat.shape)
+            shape[dim] = 2
+            idx.append(np.stack([lo, hi]).reshape(shape))
+            weight = weight * np.stack([1 - frac, frac]).reshape(shape)
+        idx = tuple(idx)
+
+        results = []
+        for name in names:
+            result = (weight * self.values[name][idx]).sum(axis=(0, 1, 2, 3))
+            result = np.where(valid, result, np.nan)
+            results.append(float(result) if result.ndim == 0 else result)
+        return results
+
+    # pure Python path for single points, avoiding numpy per-call overhead
+    def _interp_point(self, names, t, lat, lon, lev):
+        locs = [self.time.locate_scalar(float(pd.Timestamp(t).value)), self.level.locate_scalar(lev),
+                self.latitude.locate_scalar(lat), self.longitude.locate_scalar(lon)]
+        if any(loc is None for loc in locs):
+            return [np.nan] * len(names)
+
+        corners = []
+        for corner in product((0, 1), repeat=4):
+            weight = 1.
+            for (lo, hi, frac), c in zip(locs, corner):
+                weight *= frac if c else 1 - frac
+            if weight:
+                corners.append((tuple(loc[c] for loc, c in zip(locs, corner)), weight))
+
+        return [sum(weight * float(self.values[name][idx]) for idx, weight in corners) for name in names]
+
+    # Integrates back from times[0] through each of the output `times`.
+    #
+    # method: 'petterssen' (the two-stage scheme of back_trajectory) or 'rk4'.
+    # substeps: fixed number of equal steps between consecutive output times; the
+    #   winds in between are interpolated in time, so output times need not be
+    #   data times.
+    # tolerance: if given (km), ignore `substeps` and adapt the step instead:
+    #   each step is compared against two half steps and halved until the largest
+    #   parcel displacement difference is within tolerance (or min_step is
+    #   reached), then allowed to double again on the next step.
+    def back_trajectories(self, lats, lons, levels, times, method='petterssen', substeps=1,
+                          tolerance=None, min_step=pd.Timedelta(5, 'min')):
+        lats, lons, levels = np.broadcast_arrays(*(np.atleast_1d(np.asarray(x, dtype=np.float64))
+                                                   for x in (lats, lons, levels)))
+        pos = (lats.copy(), lons.copy(), levels.copy())
+        times = [pd.Timestamp(t) for t in times]
+        if len(times) < 2:
+            raise ValueError('len(times) must >= 2')
+        if method not in self.STEPPERS:
+            raise ValueError(f'Unknown method {method}; must be one of {list(self.STEPPERS)}')
+        step = getattr(self, self.STEPPERS[method])
+
+        names = ['lat', 'lon', 'level'] + (['T'] if self.has_temperature else [])
+        result = {name: np.full((len(lats), len(times)), np.nan) for name in names}
+
+        def store(i, t, pos_):
+            result['lat'][:, i], result['lon'][:, i], result['level'][:, i] = pos_
+            if self.has_temperature:
+                result['T'][:, i] = self.interp('T', t, *pos_)
+
+        store(0, times[0], pos)
+
+        dt = None
+        for i, (t, t1) in enumerate(zip(times[:-1], times[1:]), start=1):
+            if tolerance is None:
+                h = (t - t1) / substeps
+                for k in range(substeps):
+                    pos = step(t - k * h, pos, h)
+            else:
+                pos, dt = self._adaptive_steps(step, t, t1, pos, tolerance, min_step, dt)
+            store(i, t1, pos)
+
+        return xr.Dataset(
+            {name: (('parcel', 'time'), values) for name, values in result.items()},
+            coords={'parcel': np.arange(len(lats)), 'time': times},
+        )
+
+    # each stepper moves parcels at `pos` = (lat, lon, lev) from t back to t - dt
+    def _petterssen_step(self, t, pos, dt):
+        lat, lon, lev = pos
+        ut, vt, wt = self.winds(t, lat, lon, lev)
+        lon1, lat1, lev1 = calc_step(ut, vt, wt, lon, lat, lev, dt)
+
+        ut2, vt2, wt2 = self.winds(t - dt, lat1, lon1, lev1)
+        lon2, lat2, lev2 = calc_step(ut2, vt2, wt2, lon, lat, lev, dt)
+
+        return (lat1 + lat2) / 2, (lon1 + lon2) / 2, (lev1 + lev2) / 2
+
+    # Classic RK4 on the spherical-coordinate tendencies of the wind. Unlike
+    # calc_step, which moves along a great circle at the starting bearing, this
+    # follows e.g. a pure westerly along its latitude circle, so the scheme keeps
+    # its fourth order convergence as the step shrinks.
+    def _rk4_step(self, t, pos, dt):
+        hours = dt / pd.Timedelta(1, 'h')
+
+        def tendency(t_, pos_):
+            return _tendencies(*self.winds(t_, *pos_), pos_[0])
+
+        def offset(pos_, k, frac):
+            return tuple(x - frac * hours * dx for x, dx in zip(pos_, k))
+
+        k1 = tendency(t, pos)
+        k2 = tendency(t - dt / 2, offset(pos, k1, 0.5))
+        k3 = tendency(t - dt / 2, offset(pos, k2, 0.5))
+        k4 = tendency(t - dt, offset(pos, k3, 1))
+        k = tuple((a + 2 * b + 2 * c + d) / 6 for a, b, c, d in zip(k1, k2, k3, k4))
+        return offset(pos, k, 1)
+
+    # Steps never straddle a data time, where the time-interpolated winds have a kink
+    # that would otherwise dominate the step doubling error estimate.
+    def _adaptive_steps(self, step, t, t1, pos, tolerance, min_step, dt=None):
+        data_times = self.coords['time']
+        dt = t - t1 if dt is None else dt
+        while t > t1:
+            i = np.searchsorted(data_times, t.to_datetime64(), side='left') - 1
+            stop = max(t1, pd.Timestamp(data_times[i])) if i >= 0 else t1
+            dt = min(dt, t - stop)
+            full = step(t, pos, dt)
+            half = step(t - dt / 2, step(t, pos, dt / 2), dt / 2)
+            err = np.nanmax(_distance_km(full, half), initial=0)
+            if err > tolerance and dt / 2 >= min_step:
+                dt = dt / 2
+                continue
+
+            pos, t = half, t - dt
+            if err < tolerance / 4:
+                dt = dt * 2
+        return pos, dt
+
+
+# positions of `data_times` from the last at or before `tmin` to the first at or
+# after `tmax`
+def _time_span(data_times, tmin, tmax):
+    lo = max(data_times.searchsorted(pd.Timestamp(tmin), side='right') - 1, 0)
+    hi = data_times.searchsorted(pd.Timestamp(tmax), side='left')
+    return slice(lo, hi + 1)
+
+
+def _subset(da, times=None, bbox=None, levels=None):
+    kw = {}
+    if times is not None:
+        da = da.isel(time=_time_span(da.indexes['time'], *times))
+    if levels is not None:
+        kw['level'] = levels
+    if bbox is not None:
+        west, east, south, north = bbox
+        lats = da['latitude'].values
+        kw['latitude'] = slice(north, south) if lats[0] > lats[-1] else slice(south, north)
+    da = da.sel(**kw)
+
+    if bbox is not None:
+        # select the columns in the box in order from the west edge, so a box crossing
+        # the 0/360 seam comes back as one continuous run of longitudes
+        lons = da['longitude'].values
+        offset = np.mod(lons - west, 360)
+        cols = np.flatnonzero(offset <= np.mod(east - west, 360))
+        cols = cols[np.argsort(offset[cols], kind='stable')]
+        da = da.isel(longitude=cols)
+        da = da.assign_coords(longitude=west + offset[cols])
+    return da
+
+
+# One grid dimension. locate() returns the lower/upper bracketing indices, the
+# fractional distance between them, and whether each point lies inside the grid.
+# Regular spacing (ascending or descending) is located with pure arithmetic;
+# irregular coordinates (e.g. ERA5 pressure levels) with np.interp on the index.
+# With `wrap`, points are first brought into [coord[0], coord[0] + wrap); a grid
+# spanning the full period also interpolates across its last and first columns.
+class _Axis(object):
+    def __init__(self, coord, wrap=None):
+        self.coord = np.asarray(coord, dtype=np.float64)
+        self.n = len(self.coord)
+        self.start = self.coord[0]
+        self.wrap = wrap
+
+        diffs = np.diff(self.coord)
+        self.step = diffs[0] if self.n > 1 else 1.
+        self.regular = self.n > 1 and np.allclose(diffs, self.step)
+        self.periodic = wrap is not None and self.regular and np.isclose(abs(self.step) * self.n, wrap)
+        self.lower, self.upper = self.coord.min(), self.coord.max()
+
+        order = np.argsort(self.coord)
+        self._sorted_coord = self.coord[order]
+        self._sorted_index = order.astype(np.float64)
+
+    # scalar version of locate(); returns None for points outside the grid
+    def locate_scalar(self, x):
+        if self.wrap is not None:
+            x = self.start + (x - self.start) % self.wrap
+
+        if self.n == 1:
+            return (0, 0, 0.) if x == self.start else None
+        if not self.periodic and not self.lower <= x <= self.upper:
+            return None
+
+        if self.regular:
+            pos = (x - self.start) / self.step
+        else:
+            pos = float(np.interp(x, self._sorted_coord, self._sorted_index))
+
+        if self.periodic:
+            i = min(int(math.floor(pos)), self.n - 1)
+            return i, (i + 1) % self.n, pos - i
+        i = min(max(int(math.floor(pos)), 0), self.n - 2)
+        return i, i + 1, pos - i
+
+    def locate(self, x):
+        if self.wrap is not None:
+            x = self.start + np.mod(x - self.start, self.wrap)
+
+        if self.n == 1:
+            zeros = np.zeros(x.shape, dtype=np.intp)
+            return zeros, zeros, np.zeros(x.shape), x == self.start
+
+        if self.regular:
+            pos = (x - self.start) / self.step
+        else:
+            pos = np.interp(x, self._sorted_coord, self._sorted_index)
+
+        if self.periodic:
+            valid = np.isfinite(pos)
+            pos = np.where(valid, pos, 0)
+            i = np.clip(np.floor(pos).astype(np.intp), 0, self.n - 1)
+            return i, (i + 1) % self.n, pos - i, valid
+
+        valid = (x >= self.lower) & (x <= self.upper)
+        pos = np.where(valid, pos, 0)
+        i = np.clip(np.floor(pos).astype(np.intp), 0, self.n - 2)
+        return i, i + 1, pos - i, valid
+
+
 def sel(ds, t, lon, lat, lev):
     sel_kw = {'time': t}
     lonmin, lonmax = lon - 5 + 360, lon + 5 + 360
@@ -55,6 +367,21 @@ def sel(ds, t, lon, lat, lev):
     return ds_subset.interp(latitude=lat, longitude=lon + 360, level=lev)
 
 
+# (lat, lon, level) rates of change in degrees or hPa per hour, for winds u, v in
+# m/s and w in Pa/s at latitude `lat`
+def _tendencies(u, v, w, lat, R=6378.1):
+    dlat = np.degrees(v * 3.6 / R)
+    dlon = np.degrees(u * 3.6 / (R * np.cos(np.radians(lat))))
+    return dlat, dlon, w * 36
+
+
+# great circle distance between the (lat, lon, ...) positions a and b
+def _distance_km(a, b, R=6378.1):
+    lat0, lon0, lat1, lon1 = map(np.radians, (a[0], a[1], b[0], b[1]))
+    h = np.sin((lat1 - lat0) / 2) ** 2 + np.cos(lat0) * np.cos(lat1) * np.sin((lon1 - lon0) / 2) ** 2
+    return 2 * R * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
 def dest_pt(lon0, lat0, bearing, dist, R=6378.1):
     lon0 = np.radians(lon0)
     lat0 = np.radians(lat0)
@@ -87,4 +414,5 @@ def calc_step(u, v, w, lon, lat, lev, dt, back=True):
     r = mps_to_kph(np.sqrt(v ** 2 + u ** 2)) * dt
     lon1, lat1 = dest_pt(lon, lat, theta, r)
 
-    return lon1, lat1, lev + dlev
+    # going back in time, a sinking parcel (w > 0) came from lower pressure
+    return lon1, lat1, lev - dlev if back else lev + dlev